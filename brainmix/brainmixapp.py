@@ -22,6 +22,18 @@ if __name__ == '__main__':
                         help='Run application without a Graphical User Interface.')
     parser.add_argument('-i', action='store', dest='inputDir',
                         help='Directory containing images to open on startup.')
+    parser.add_argument('--ondisk', action='store_true',
+                        help='Keep image stacks in memory-mapped scratch files (for large stacks).')
+    parser.add_argument('--scratchdir', action='store', dest='scratchDir',
+                        help='Directory for scratch files (default: system temp directory).')
+    parser.add_argument('--lazy', action='store_true',
+                        help='Decode each image only when it is first displayed or used.')
+    parser.add_argument('--workers', action='store', dest='nWorkers', type=int, default=1,
+                        help='Number of parallel workers for decoding images (0 for all CPUs).')
+    parser.add_argument('--threads', action='store_true',
+                        help='Use threads instead of processes for parallel workers.')
+    parser.add_argument('--tiled', action='store_true',
+                        help='Show images with tiled multi-resolution rendering (for very large images).')
     args = parser.parse_args()
 
     if args.nogui:
@@ -31,8 +43,10 @@ if __name__ == '__main__':
         app=QtGui.QApplication.instance() # checks if QApplication already exists 
         if not app: # create QApplication if it doesnt exist 
             app = QtGui.QApplication(sys.argv)
-        mainSession = session.Session(inputdir=args.inputDir)
-        mainWindow = mainwindow.MainWindow(mainSession)
+        mainSession = session.Session(inputdir=args.inputDir, ondisk=args.ondisk,
+                                      scratchdir=args.scratchDir, lazy=args.lazy,
+                                      nworkers=args.nWorkers or None, usethreads=args.threads)
+        mainWindow = mainwindow.MainWindow(mainSession, tiled=args.tiled)
         mainWindow.show()
         sys.exit(app.exec_())
 
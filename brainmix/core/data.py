@@ -4,24 +4,170 @@ Main data structure to contain images stacks.
 Please see the AUTHORS file for credits.
 '''
 
+import os
 import copy
+import atexit
+import tempfile
+import weakref
+import threading
+import itertools
+import collections
+import numpy as np
+
+_stackIDs = itertools.count() # Unique IDs for each set of images
+_onDiskStacks = weakref.WeakSet() # Stacks with scratch files to remove when exiting
+
+def _release_on_disk_stacks():
+    '''Remove the scratch files of the stacks still in use (called when exiting)'''
+    for stack in list(_onDiskStacks):
+        stack.release()
+atexit.register(_release_on_disk_stacks)
 
 class ImageStack(object):
-    def __init__(self):
-        '''Data structure for images'''
+    def __init__(self, ondisk=False, scratchdir=None):
+        '''
+        Data structure for images
+
+        PARAMETERS:
+        ondisk: [Boolean] keep images in a memory-mapped scratch file instead of RAM.
+        scratchdir: [string] folder for scratch files (default: system temp folder).
+        '''
         self.fileNames = []
         self.images = []
         self.nImages = 0
         self.bitDepth = None
+        self.stackID = next(_stackIDs) # Changes every time the images change
+        self.onDisk = ondisk
+        self.scratchDir = scratchdir
+        self.scratchFile = None
+        if self.onDisk:
+            _onDiskStacks.add(self)
+
+    def __del__(self):
+        # -- Stacks discarded before exiting remove their scratch file here --
+        self.release()
+
+    def allocate(self, nimages, shape, dtype, bitdepth=None):
+        '''
+        Create an empty stack to be filled one slice at a time.
+        If the stack is on disk, slices are stored in a memory-mapped scratch file.
+        Returns the new array of images.
+        '''
+        self.release()
+        stackShape = (nimages,)+tuple(shape)
+        if self.onDisk:
+            (fd, self.scratchFile) = tempfile.mkstemp(prefix='brainmix_', suffix='.stack',
+                                                      dir=self.scratchDir)
+            os.close(fd)
+            self.images = np.memmap(self.scratchFile, dtype=dtype, mode='w+', shape=stackShape)
+        else:
+            self.images = np.empty(stackShape, dtype=dtype)
+        self.nImages = nimages
+        self.stackID = next(_stackIDs)
+        if bitdepth is not None:
+            self.bitDepth = bitdepth
+        return self.images
+
     def set_images(self, images, bitdepth=None):
         '''Set the number of images and the original image data'''
+        if self.onDisk and isinstance(images, np.ndarray) and images is not self.images:
+            # -- Copy one slice at a time to avoid holding the whole stack in RAM --
+            self.allocate(len(images), images[0].shape, images[0].dtype)
+            for ind in range(len(images)):
+                self.images[ind] = images[ind]
+            self.images.flush()
+        else:
+            self.images = images
         self.nImages = len(images)
-        self.images = images
-        if bitdepth is not None: 
+        self.stackID = next(_stackIDs)
+        if bitdepth is not None:
             self.bitDepth = bitdepth
+
     def set_filenames(self, files):
         '''Set the names of the image files'''
         self.fileNames = files
+
+    def release(self):
+        '''Free the image data (and remove the scratch file if there is one)'''
+        self.images = []
+        self.nImages = 0
+        if self.scratchFile is not None:
+            try:
+                os.remove(self.scratchFile)
+            except OSError:
+                pass # File may still be mapped by another array (e.g., on Windows)
+            self.scratchFile = None
+
     def copy(self):
+        if self.onDisk:
+            newStack = ImageStack(ondisk=True, scratchdir=self.scratchDir)
+            newStack.set_filenames(list(self.fileNames))
+            newStack.bitDepth = self.bitDepth
+            if self.nImages:
+                newStack.set_images(self.images)
+            return newStack
         return copy.deepcopy(self)
 
+
+class LazyImageArray(object):
+    def __init__(self, files, load_func, cachesize=32, **load_func_kwargs):
+        '''
+        Stack of images that are decoded only when accessed.
+
+        It supports images[i], len() and iteration like an ndarray stack.
+        The most recently used slices are kept in memory (up to cachesize).
+        Slices can be requested from several threads (e.g., the viewer prefetcher).
+
+        PARAMETERS:
+        files: [list] names of image files (one per slice).
+        load_func: [function] called as load_func(filename, **load_func_kwargs).
+        cachesize: [int] maximum number of decoded slices kept in memory.
+        '''
+        self.files = files
+        self.load_func = load_func
+        self.loadFuncKwargs = load_func_kwargs
+        self.cacheSize = max(1, cachesize)
+        self._cache = collections.OrderedDict() # Ordered from least to most recently used
+        self._lock = threading.Lock()
+        # -- Decode the first image to find out the size and type of all slices --
+        firstImage = self[0]
+        self.shape = (len(files),)+firstImage.shape
+        self.dtype = firstImage.dtype
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return len(self.files)
+
+    def __iter__(self):
+        for ind in range(len(self)):
+            yield self[ind]
+
+    def __getitem__(self, ind):
+        if isinstance(ind, slice):
+            return np.array([self[oneInd] for oneInd in range(*ind.indices(len(self)))])
+        ind = int(ind)
+        if ind < 0:
+            ind += len(self)
+        if ind < 0 or ind >= len(self):
+            raise IndexError('Image index out of range')
+        with self._lock:
+            image = self._cache.pop(ind, None)
+            if image is not None:
+                self._cache[ind] = image
+                return image
+        # -- Decode outside the lock so other threads can use cached slices meanwhile --
+        image = self.load_func(self.files[ind], **self.loadFuncKwargs)
+        with self._lock:
+            self._cache.pop(ind, None)
+            while len(self._cache) >= self.cacheSize:
+                self._cache.popitem(last=False)
+            self._cache[ind] = image
+        return image
+
+    def is_loaded(self, ind):
+        '''Return True if the slice is already decoded'''
+        return ind in self._cache
+
+    def copy(self):
+        '''Decode all slices and return them as an ndarray'''
+        return self[:]
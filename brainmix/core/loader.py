@@ -0,0 +1,101 @@
+'''
+Load a stack of image files using a pool of workers.
+
+Please see the AUTHORS file for credits.
+'''
+
+import multiprocessing
+import multiprocessing.pool
+import numpy as np
+
+
+class SliceLoader(object):
+    def __init__(self, files, load_func, load_func_kwargs, scratchfile=None, shape=None, dtype=None):
+        '''
+        Callable that decodes one slice given its index.
+
+        Process workers receive a pickled copy of this object, so load_func needs
+        to be a module-level function. If scratchfile is given (a stack on disk),
+        each worker writes its slice directly into the memory-mapped file instead
+        of sending the image back to the main process.
+        '''
+        self.files = files
+        self.load_func = load_func
+        self.loadFuncKwargs = load_func_kwargs
+        self.scratchFile = scratchfile
+        self.shape = shape
+        self.dtype = dtype
+
+    def __call__(self, ind):
+        image = self.load_func(self.files[ind], **self.loadFuncKwargs)
+        if self.scratchFile is None:
+            return image
+        images = np.memmap(self.scratchFile, dtype=self.dtype, mode='r+', shape=self.shape)
+        images[ind] = image
+        images.flush()
+        del images
+        return None
+
+
+def load_stack(files, imagestack, load_func, nworkers=None, usethreads=False, **load_func_kwargs):
+    '''
+    Decode image files in parallel and store them in a preallocated ImageStack.
+
+    The first file is decoded in the calling process to find the size and type of
+    the images. Slice i of the stack always corresponds to files[i], no matter in
+    which order the workers finish.
+
+    Args:
+        files (list): names of image files, in the order they should appear in the stack.
+        imagestack (data.ImageStack): stack where the images will be stored.
+        load_func (function): called as load_func(filename, **load_func_kwargs).
+        nworkers (int): number of workers. Default: number of CPUs.
+        usethreads (bool): use a pool of threads instead of processes.
+
+    Returns:
+        images (np.ndarray): [nImages, height, width] images (same as imagestack.images).
+    '''
+    if nworkers is None:
+        nworkers = multiprocessing.cpu_count()
+    nImages = len(files)
+    firstImage = load_func(files[0], **load_func_kwargs)
+    images = imagestack.allocate(nImages, firstImage.shape, firstImage.dtype)
+    images[0] = firstImage
+    remaining = range(1, nImages)
+    if nworkers <= 1 or nImages < 3:
+        for ind in remaining:
+            images[ind] = load_func(files[ind], **load_func_kwargs)
+    elif usethreads:
+        sliceLoader = SliceLoader(files, load_func, load_func_kwargs)
+        def load_one(ind):
+            images[ind] = sliceLoader(ind)
+        pool = multiprocessing.pool.ThreadPool(min(nworkers, nImages-1))
+        try:
+            pool.map(load_one, remaining)
+            pool.close()
+        except:
+            pool.terminate() # Do not leave workers running if a file could not be loaded
+            raise
+        finally:
+            pool.join()
+    else:
+        if imagestack.scratchFile is not None:
+            images.flush()
+            sliceLoader = SliceLoader(files, load_func, load_func_kwargs, imagestack.scratchFile,
+                                      images.shape, images.dtype)
+        else:
+            sliceLoader = SliceLoader(files, load_func, load_func_kwargs)
+        pool = multiprocessing.Pool(min(nworkers, nImages-1))
+        try:
+            for ind, image in zip(remaining, pool.imap(sliceLoader, remaining)):
+                if image is not None:
+                    images[ind] = image
+            pool.close()
+        except:
+            pool.terminate() # Do not leave workers running if a file could not be loaded
+            raise
+        finally:
+            pool.join()
+    if isinstance(images, np.memmap):
+        images.flush()
+    return images
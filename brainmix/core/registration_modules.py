@@ -6,8 +6,11 @@ Please see the AUTHORS file for credits.
 '''
 
 import sys
+import numpy as np
 
 # - Load in all registration modules - #
+# Each function is called as function(img_stack, targetInd, **options) and returns the
+# registered stack, or (registered stack, transformations) if options['returntransforms'].
 methods = []
 functions = []
 
@@ -16,9 +19,21 @@ from ..modules import stackreg
 methods.append("Thevenaz")
 functions.append(stackreg.register_stack)
 
+# -- Thevenaz affine (rigid-body registration refined with affine transformations) --
+def thevenaz_affine(img_stack, targetInd=0, **kwargs):
+    return stackreg.register_stack(img_stack, targetInd, method='affine', **kwargs)
+methods.append("Thevenaz (affine)")
+functions.append(thevenaz_affine)
+
 # -- Dummy (return the original stack) --
-def dummy(img_stack): 
-    return img_stack
+def dummy(img_stack, targetInd=0, outstack=None, returntransforms=False, **kwargs):
+    if outstack is not None:
+        outstack[:] = img_stack
+    else:
+        outstack = img_stack
+    if returntransforms:
+        return (outstack, np.zeros((len(img_stack), 3)))
+    return outstack
 methods.append('Dummy')
 functions.append(dummy)
 
@@ -7,22 +7,43 @@ Please see the AUTHORS file for credits.
 
 import glob
 import os
+import numpy as np
 import skimage.io
 import skimage.exposure
 from . import data
+from . import loader
 from ..core import registration_modules
 from ..modules import czifile
 
 class Session(object):
-    def __init__(self, inputdir=None):
-        '''Application session'''
+    def __init__(self, inputdir=None, ondisk=False, scratchdir=None, lazy=False, cachesize=32,
+                 nworkers=1, usethreads=False):
+        '''
+        Application session
+
+        PARAMETERS:
+        inputdir: [string] folder with images to open at start.
+        ondisk: [Boolean] keep image stacks in memory-mapped scratch files (for large stacks).
+        scratchdir: [string] folder for scratch files (default: system temp folder).
+        lazy: [Boolean] decode each image only when it is first accessed.
+        cachesize: [int] number of decoded images kept in memory when lazy is True.
+        nworkers: [int] number of parallel workers for decoding and registering images
+                  (None for all CPUs).
+        usethreads: [Boolean] use threads instead of processes for parallel workers.
+        '''
         self.inputdir=inputdir
+        self.lazyLoading = lazy
+        self.cacheSize = cachesize
+        self.nWorkers = nworkers
+        self.useThreads = usethreads
         self.filenames = []
-        self.origImages = data.ImageStack()
-        self.alignedImages = data.ImageStack()
+        self.origImages = data.ImageStack(ondisk=ondisk, scratchdir=scratchdir)
+        self.alignedImages = data.ImageStack(ondisk=ondisk, scratchdir=scratchdir)
         #self.displayedImages = data.ImageStack()
         self.currentImageInd = 0
+        self.levels = None # Display levels (darkest, brightest)
         self.aligned = False
+        self.transforms = None # Transformation of each image found by the last registration
         #self.displayed = False
         self.loaded = False
 
@@ -43,10 +64,29 @@ class Session(object):
         '''Return current image'''
         #if self.displayed:
         #    return self.displayedImages.images[self.currentImageInd]
+        return self.get_image(self.currentImageInd, aligned)
+
+    def get_image(self, imageInd, aligned=False):
+        '''Return image given its index in the stack'''
         if aligned:
-            return self.alignedImages.images[self.currentImageInd]
+            return self.alignedImages.images[imageInd]
         else:
-            return self.origImages.images[self.currentImageInd]
+            return self.origImages.images[imageInd]
+
+    def get_data_key(self, imageInd, aligned=False):
+        '''
+        Return a key that identifies the data of an image.
+        It changes when the images change.
+        '''
+        imageStack = self.alignedImages if aligned else self.origImages
+        return (imageStack.stackID, imageInd, aligned)
+
+    def get_display_key(self, imageInd, aligned=False):
+        '''
+        Return a key that identifies how an image looks on screen.
+        It changes when the images or the display levels change.
+        '''
+        return self.get_data_key(imageInd, aligned) + (self.levels,)
 
     def set_registration_method(self,regMethodIndex):
         '''Set the registration method by index'''
@@ -57,16 +97,29 @@ class Session(object):
         if len(files) > 0:
             self.filenames = files
             # -- Load in the images --
-            imageCollection = skimage.io.ImageCollection(files, as_grey=True, 
-                                                         load_func=self.img_load_func)
-            if imageCollection[0].dtype=='uint16':
+            if self.lazyLoading:
+                # -- Only the first image is decoded now, the rest on demand --
+                lazyImages = data.LazyImageArray(files, load_image, cachesize=self.cacheSize,
+                                                 as_grey=True)
+                self.origImages.set_images(lazyImages)
+            elif self.origImages.onDisk or self.nWorkers != 1:
+                # -- Decode images (in parallel) straight into the preallocated stack --
+                loader.load_stack(files, self.origImages, load_image, nworkers=self.nWorkers,
+                                  usethreads=self.useThreads, as_grey=True)
+            else:
+                imageCollection = skimage.io.ImageCollection(files, as_grey=True, 
+                                                             load_func=self.img_load_func)
+                self.origImages.set_images(imageCollection.concatenate())
+            imageType = self.origImages.images[0].dtype
+            if imageType=='uint16' or imageType.kind=='f':
                 # FIXME: this assumes 16bit images are really 12bit (true for LISB scope)
+                #        Float images come from CZI files, which are also 12bit.
                 bitdepth = 12
             else:
                 bitdepth = 8
-            # FIXME: the bitdepth is not used yet by other functions.
-            #        We need to use it when converting to QImage
-            self.origImages.set_images(imageCollection.concatenate(),bitdepth=bitdepth)
+            self.origImages.bitDepth = bitdepth
+            self.levels = None
+            self.transforms = None
             #self.displayedImages = self.origImages.copy()
             self.alignedImages.bitDepth = bitdepth # FIXME: maybe the bitdepth is different
             # -- Save the filenames --
@@ -76,22 +129,7 @@ class Session(object):
         '''
         A function that allows loading files of different formats
         '''
-        fileName,fileExt = os.path.splitext(imgfile)
-        if fileExt.lower() == '.czi':
-            czi = czifile.CziFile(imgfile)
-            image4D = czi.asarray()
-            if as_grey:
-                #image = image4D[0,:,:,0] # 2D (taking only first channel)
-                image = image4D[0,:,:,0].astype(float) # 2D (taking only first channel)
-            else:
-                raise TypeError('Loading multichannel images has not been implemented.')
-                #image = np.rollaxis(image4D,0,3)[:,:,:,0] # 3D
-            ###image2D = (image2D/16).astype(np.uint8)
-            ### For 3D images: np.rollaxis(image4D,0,3)[:,:,:,0]
-            return image
-        else:
-            #return skimage.io.imread(imgfile,as_grey)
-            return (256*skimage.io.imread(imgfile,as_grey)).astype('uint8') # FIXME: should it be 255?
+        return load_image(imgfile,as_grey)
 
     def increment_current_image(self):
         '''Increment the current image number'''
@@ -105,26 +143,106 @@ class Session(object):
         if self.currentImageInd < 0:
             self.currentImageInd = self.origImages.nImages-1
 
-    def register_stack(self):
-        '''Apply registration algorithm to image stack'''
+    def register_stack(self, progress=None):
+        '''
+        Apply registration algorithm to image stack.
+        Images are registered on a pool of workers if nWorkers is not 1.
+        The transformation of each image is kept in self.transforms.
+
+        PARAMETERS:
+        progress: [function] called as progress(nDone, nTotal) during registration.
+        '''
+        alignedImages = self.new_aligned_stack()
+        tfrms = self.compute_registration(alignedImages, progress)
+        self.set_registration(alignedImages, tfrms)
+
+    def new_aligned_stack(self):
+        '''
+        Return an empty stack for the results of a registration.
+        If stacks are on disk, it is allocated in a new scratch file, so the
+        current aligned images remain valid until set_registration() is called.
+        '''
+        alignedImages = data.ImageStack(ondisk=self.alignedImages.onDisk,
+                                        scratchdir=self.alignedImages.scratchDir)
+        alignedImages.set_filenames(list(self.origImages.fileNames))
+        alignedImages.bitDepth = self.origImages.bitDepth
+        if alignedImages.onDisk:
+            origStack = self.origImages.images
+            alignedImages.allocate(self.origImages.nImages, origStack.shape[1:], origStack.dtype)
+        return alignedImages
+
+    def compute_registration(self, alignedImages, progress=None):
+        '''
+        Register the original images and store the results in alignedImages
+        (from new_aligned_stack). It does not change the aligned images of the
+        session, so it can run on a separate thread while they are displayed.
+        Returns the transformation of each image.
+
+        PARAMETERS:
+        alignedImages: [data.ImageStack] stack for the registered images.
+        progress: [function] called as progress(nDone, nTotal) during registration.
+        '''
         regFunction = self.regFunctions[self.currentRegMethodIndex]
         #regImages = regFunction(self.origImages.images)
-        regImages = regFunction(self.origImages.images, self.currentImageInd)
+        regOptions = {'parallel': self.nWorkers != 1, 'nworkers': self.nWorkers,
+                      'usethreads': self.useThreads, 'progress': progress,
+                      'returntransforms': True}
+        if alignedImages.onDisk:
+            # -- Registered images are written directly into a scratch file --
+            regOptions['outstack'] = alignedImages.images
+        (regImages, tfrms) = regFunction(self.origImages.images, self.currentImageInd, **regOptions)
         #regImages = regFunction(self.origImages.images, self.currentImageInd, relative=False)
-        self.alignedImages.set_images(regImages)
-        aligned = True
+        alignedImages.set_images(regImages)
+        return tfrms
+
+    def set_registration(self, alignedImages, tfrms):
+        '''Replace the aligned images and transformations with those of a new registration'''
+        self.alignedImages.release()
+        self.alignedImages = alignedImages
+        self.transforms = tfrms
+        self.aligned = True
+
+    def save_transforms(self, filename):
+        '''
+        Save the transformations from the last registration to a text file.
+        Each row corresponds to one image: [theta, tx, ty] for rigid-body registration,
+        or the 9 values of the (3,3) matrix (row by row) for affine registration.
+        '''
+        if self.transforms is None:
+            raise ValueError('There are no transformations to save (register the stack first).')
+        tfrms = np.asarray(self.transforms)
+        if tfrms.ndim == 2:
+            header = 'theta tx ty'
+        else:
+            header = 'a00 a01 a02 a10 a11 a12 a20 a21 a22'
+        np.savetxt(filename, tfrms.reshape(len(tfrms), -1), header=header)
 
     def change_levels(self,levels):
-        '''Adjust intensity of pixels'''
-        pass
         '''
-        # -- This method needs to be tested --
-        ind = self.currentImageInd
-        self.displayed = True
-        self.displayedImages.images[ind,:,:] = \
-            skimage.exposure.rescale_intensity(self.origImages.images[ind,:,:],levels)
-        #print '[session.py]'
-        #print levels
-        #print self.displayedImages.images[ind,:,:].min(), self.displayedImages.images[ind,:,:].max()
+        Adjust intensity of pixels.
+        Levels are applied only when converting images for display (the data is not modified).
         '''
+        self.levels = tuple(levels)
+
 
+def load_image(imgfile,as_grey=False):
+    '''
+    A function that allows loading files of different formats.
+    Defined at module level so it can be sent to a pool of worker processes.
+    '''
+    fileName,fileExt = os.path.splitext(imgfile)
+    if fileExt.lower() == '.czi':
+        czi = czifile.CziFile(imgfile)
+        image4D = czi.asarray()
+        if as_grey:
+            #image = image4D[0,:,:,0] # 2D (taking only first channel)
+            image = image4D[0,:,:,0].astype(float) # 2D (taking only first channel)
+        else:
+            raise TypeError('Loading multichannel images has not been implemented.')
+            #image = np.rollaxis(image4D,0,3)[:,:,:,0] # 3D
+        ###image2D = (image2D/16).astype(np.uint8)
+        ### For 3D images: np.rollaxis(image4D,0,3)[:,:,:,0]
+        return image
+    else:
+        #return skimage.io.imread(imgfile,as_grey)
+        return (256*skimage.io.imread(imgfile,as_grey)).astype('uint8') # FIXME: should it be 255?
@@ -9,6 +9,7 @@ Please see the AUTHORS file for credits.
 
 from PySide import QtGui
 from PySide import QtCore
+import struct
 import numpy as np
 from . import multipleslider
 
@@ -17,29 +18,123 @@ class HistogramEditor(QtGui.QWidget):
         super(HistogramEditor, self).__init__(parent)
         self.histView = HistogramView()
         self.sliders = multipleslider.MultipleSlider()
+        self.wholeStackCheck = QtGui.QCheckBox('Whole stack')
+        self.histCache = HistogramCache()
+        self.stackWorker = None
+        self.stackID = None
+        self.stackImages = None
+        self.nbins = None
+        self.stackHist = None
+        self.currentImage = None
+        self.currentImageInd = None
 
         layout = QtGui.QVBoxLayout()
         layout.addWidget(self.histView)
         layout.addWidget(self.sliders)
+        layout.addWidget(self.wholeStackCheck)
         self.setLayout(layout)
  
         QtGui.QShortcut(QtGui.QKeySequence("Ctrl+W"), self, self.close,
                         context=QtCore.Qt.WidgetShortcut)
 
         self.sliders.sliderMoved.connect(self.set_bounds)
+        self.wholeStackCheck.toggled.connect(self.toggle_whole_stack)
 
     def reset(self,nbins):
         self.sliders.setMaximum(nbins-1)
         self.sliders.setValues([0,nbins-1])
         self.show()
+
+    def set_stack(self,stackID,images,nbins):
+        '''
+        Set the stack of images. The histogram of the whole stack is computed in the
+        background only if 'Whole stack' is checked (see start_stack_histogram).
+        '''
+        if stackID==self.stackID and nbins==self.nbins:
+            return
+        self.stop_stack_histogram()
+        self.histCache.keep_only(stackID)
+        self.stackID = stackID
+        self.stackImages = images
+        self.nbins = nbins
+        self.stackHist = None
+        if self.wholeStackCheck.isChecked():
+            self.start_stack_histogram()
+
+    def start_stack_histogram(self):
+        '''
+        Compute the histogram of the whole stack in the background (which also fills
+        the cache of per-image histograms). Stacks that are not in memory (e.g., a
+        data.LazyImageArray) need to decode every file, so the user is asked first.
+        Returns False if the user declined.
+        '''
+        if self.stackWorker is not None or self.stackHist is not None or self.stackImages is None:
+            return True
+        if not isinstance(self.stackImages,np.ndarray):
+            answer = QtGui.QMessageBox.question(self,'Whole stack histogram',
+                                                'All {0} images will be read from disk '
+                                                'to calculate the histogram. '
+                                                'Continue?'.format(len(self.stackImages)),
+                                                QtGui.QMessageBox.Yes|QtGui.QMessageBox.No)
+            if answer != QtGui.QMessageBox.Yes:
+                return False
+        self.stackWorker = StackHistogramWorker(self.histCache,self.stackID,self.stackImages,
+                                                self.nbins,parent=self)
+        self.stackWorker.stackHistogramReady.connect(self.store_stack_histogram)
+        self.stackWorker.start(QtCore.QThread.LowPriority)
+        return True
+
+    def stop_stack_histogram(self):
+        if self.stackWorker is not None:
+            self.stackWorker.stop()
+            self.stackWorker = None
+
+    @QtCore.Slot(bool)
+    def toggle_whole_stack(self,checked):
+        '''Start or stop computing the histogram of the whole stack, then show it'''
+        if checked:
+            if not self.start_stack_histogram():
+                self.wholeStackCheck.setChecked(False)
+                return
+        else:
+            self.stop_stack_histogram()
+        self.show_histogram()
+
+    @QtCore.Slot(object,object)
+    def store_stack_histogram(self,stackID,hist):
+        if stackID==self.stackID:
+            self.stackHist = hist
+            self.stackWorker = None
+            if self.wholeStackCheck.isChecked():
+                self.show_histogram()
         
-    def set_data(self,image,nbins):
+    def set_data(self,image,nbins,imageInd=None):
         #self.sliders.reset(nbins)
         self.sliders.setMaximum(nbins-1)
-        self.histView.set_data(image,nbins)
+        self.nbins = nbins
+        self.currentImage = image
+        self.currentImageInd = imageInd
+        self.show_histogram()
         #self.set_bounds(0,0)
         #self.set_bounds(1,nbins)
 
+    def show_histogram(self):
+        '''Show histogram of current image (from the cache if available) or of the whole stack'''
+        if not self.isVisible() or self.currentImage is None:
+            return
+        if self.wholeStackCheck.isChecked():
+            if self.stackHist is not None:
+                self.histView.set_hist(self.stackHist)
+            return
+        hist = None
+        if self.currentImageInd is not None:
+            hist = self.histCache.get(self.stackID,self.currentImageInd,self.nbins)
+        if hist is None:
+            hist = image_histogram(self.currentImage,self.nbins)
+            if self.currentImageInd is not None:
+                self.histCache.add(self.stackID,self.currentImageInd,hist)
+        self.histView.set_hist(hist)
+
     def set_bounds(self,lowbound,highbound):
         self.histView.set_bounds([lowbound,highbound])
 
@@ -54,6 +149,8 @@ class HistogramView(QtGui.QWidget):
 
         self.hist = []
         self.bins = []
+        self.histPolygon = None # Polygon is only recalculated if data or size change
+        self.histPolygonSize = None
 
         self.setMinimumWidth(500)
         self.setMinimumHeight(100)
@@ -74,15 +171,14 @@ class HistogramView(QtGui.QWidget):
     def set_data(self,image,nbins):
         '''Calculate histogram and show it, given image data'''
         if self.isVisible():
-             #FIXME: calculating bins every time may be slow
-            if image.dtype==np.float:
-                bins = np.linspace(0,1,nbins)
-            else:
-                bins = np.arange(nbins)
-            (histValues, binEdges) = np.histogram(image,bins=bins)
-            self.hist = histValues
-            self.bins = binEdges[:-1]
-            self.update()
+            self.set_hist(image_histogram(image,nbins))
+
+    def set_hist(self,hist):
+        '''Show an already calculated histogram (one value per intensity level)'''
+        self.hist = hist
+        self.bins = np.arange(len(hist))
+        self.histPolygon = None
+        self.update()
 
     def set_bounds(self,bounds):
         self.boundPos = bounds
@@ -93,7 +189,7 @@ class HistogramView(QtGui.QWidget):
         width = self.width()
         height = self.height()
         xvalrange = float(xval[-1]-xval[0])
-        yvalrange = float(max(yval))
+        yvalrange = float(max(yval.max(),1))
         hval = (width * (xval-xval[0])/xvalrange).astype(int)
         vval = height-(height * (yval-yval[0])/yvalrange).astype(int)
         return (hval,vval)
@@ -124,13 +220,110 @@ class HistogramView(QtGui.QWidget):
         '''Draw histogram'''
         qp.setPen(QtCore.Qt.NoPen)
         qp.setBrush(QtCore.Qt.gray)
-        xval = np.r_[self.bins[0],self.bins,self.bins[-1]]
-        yval = np.r_[0,self.hist,0]
-        hval,vval = self.transform_coords(xval,yval)
-        histPoints = QtGui.QPolygonF()
-        for oneHval,oneVval in zip(hval,vval):
-            histPoints.append(QtCore.QPointF(oneHval,oneVval))
-        qp.drawPolygon(histPoints)
+        if self.histPolygon is None or self.histPolygonSize != self.size():
+            (bins,hist) = decimate_histogram(self.bins,self.hist,self.width())
+            xval = np.r_[bins[0],bins,bins[-1]]
+            yval = np.r_[0,hist,0]
+            hval,vval = self.transform_coords(xval,yval)
+            self.histPolygon = array2qpolygonf(hval,vval)
+            self.histPolygonSize = self.size()
+        qp.drawPolygon(self.histPolygon)
+
+
+class HistogramCache(object):
+    def __init__(self):
+        '''Histograms of individual images, indexed by stack ID and image index'''
+        self._hists = {}
+
+    def get(self,stackID,imageInd,nbins):
+        '''Return cached histogram (or None if not available)'''
+        hist = self._hists.get((stackID,imageInd))
+        if hist is not None and len(hist)==nbins:
+            return hist
+        return None
+
+    def add(self,stackID,imageInd,hist):
+        self._hists[(stackID,imageInd)] = hist
+
+    def keep_only(self,stackID):
+        '''Discard histograms from other stacks'''
+        for key in list(self._hists):
+            if key[0]!=stackID:
+                del self._hists[key]
+
+
+class StackHistogramWorker(QtCore.QThread):
+    # -- Send (stackID, histogram) when all images have been processed --
+    stackHistogramReady = QtCore.Signal(object,object)
+
+    def __init__(self,histcache,stackID,images,nbins,parent=None):
+        '''Thread that computes the histogram of each image and of the whole stack'''
+        super(StackHistogramWorker, self).__init__(parent)
+        self.histCache = histcache
+        self.stackID = stackID
+        self.images = images
+        self.nbins = nbins
+        self._stopping = False
+
+    def stop(self):
+        self._stopping = True
+        self.wait()
+
+    def run(self):
+        stackHist = np.zeros(self.nbins,dtype=np.int64)
+        for imageInd in range(len(self.images)):
+            if self._stopping:
+                return
+            hist = self.histCache.get(self.stackID,imageInd,self.nbins)
+            if hist is None:
+                hist = image_histogram(self.images[imageInd],self.nbins)
+                self.histCache.add(self.stackID,imageInd,hist)
+            stackHist += hist
+        self.stackHistogramReady.emit(self.stackID,stackHist)
+
+
+def decimate_histogram(bins,hist,npoints):
+    '''
+    Reduce histogram to at most npoints values (e.g., one per pixel of the widget).
+    Each value is the maximum of the bins it replaces, so narrow peaks remain visible.
+    '''
+    if len(hist) <= npoints:
+        return (bins,hist)
+    firstBins = np.unique(np.linspace(0,len(hist),npoints,endpoint=False).astype(int))
+    return (bins[firstBins],np.maximum.reduceat(hist,firstBins))
+
+
+def array2qpolygonf(xval,yval):
+    '''
+    Create a QPolygonF from arrays of coordinates in one bulk operation.
+    The points are written in the binary format used by QDataStream
+    (a uint32 count followed by big-endian double pairs) and read back at once.
+    '''
+    nPoints = len(xval)
+    points = np.empty(nPoints,dtype=[('x','>f8'),('y','>f8')])
+    points['x'] = xval
+    points['y'] = yval
+    byteArray = QtCore.QByteArray(struct.pack('>I',nPoints)+points.tostring())
+    stream = QtCore.QDataStream(byteArray)
+    polygon = QtGui.QPolygonF()
+    stream >> polygon
+    return polygon
+
+
+def image_histogram(image,nbins):
+    '''
+    Count the pixels at each intensity level (from 0 to nbins-1).
+    Float images are quantized to integer levels (as when displayed).
+    Values above nbins-1 are counted in the last bin (they are displayed as saturated).
+    '''
+    if image.dtype.kind=='u':
+        values = image.ravel()
+    else:
+        values = np.clip(image,0,nbins-1).astype(np.intp).ravel()
+    hist = np.bincount(values,minlength=nbins)
+    hist[nbins-1] += hist[nbins:].sum()
+    return hist[:nbins]
+
 
 ''' 
 if __name__ == "__main__" and __package__ is None:
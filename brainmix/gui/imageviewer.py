@@ -4,35 +4,50 @@ Image viewer rotates through a series of images
 Please see the AUTHORS file for credits.
 '''
 import sys
+import collections
+import numpy as np
 from PySide import QtCore 
 from PySide import QtGui
 from . import numpy2qimage
 
 class ImageViewer(QtGui.QScrollArea):
-    def __init__(self, parent=None, fit=True):
+    def __init__(self, parent=None, fit=True, cachebytes=256*2**20, tiled=False, tilesize=512):
         '''
         Widget to view a stack of images.
 
         ImageViewer contains a QLabel in which the image is painted.
         This QLabel will change size according to the user's commands.
+        In tiled mode, a TiledImageWidget is used instead. It paints only the
+        visible tiles, taken from the level of an image pyramid that matches the zoom.
 
         PARAMETERS:
         fit: [Boolean] start with image fit to window or not.
+        cachebytes: [int] memory budget for keeping converted images (QPixmap).
+        tiled: [Boolean] use tiled multi-resolution rendering (for very large images).
+        tilesize: [int] size (in pixels) of each tile in tiled mode.
         '''
         super(ImageViewer, self).__init__(parent)
+        self.pixmapCache = PixmapCache(cachebytes)
         self.scaleFactor = 1.0
         self.fitToWindow = fit
         self.origSize = None
+        self.imageSize = None # Size of the current image (at full resolution)
+        self.tiled = tiled
+        self.pyramids = collections.OrderedDict() # Recent image pyramids (for tiled mode)
+        self.maxPyramids = 4
         
         # -- Values to be used for panning with mouse --
         self.mousePos = None
         self.hScrollValue = None
         self.vScrollValue = None
 
-        self.imageLabel = QtGui.QLabel()
+        if self.tiled:
+            self.imageLabel = TiledImageWidget(tilesize, cachebytes)
+        else:
+            self.imageLabel = QtGui.QLabel()
+            self.imageLabel.setScaledContents(True)
         self.imageLabel.setBackgroundRole(QtGui.QPalette.Base)
         self.imageLabel.setSizePolicy(QtGui.QSizePolicy.Ignored, QtGui.QSizePolicy.Ignored)
-        self.imageLabel.setScaledContents(True)
         #self.imageLabel.setAlignment(QtCore.Qt.AlignCenter) # FIXME: Does not align image to scroll area
 
         self.setBackgroundRole(QtGui.QPalette.Dark)
@@ -43,16 +58,65 @@ class ImageViewer(QtGui.QScrollArea):
     def initialize(self, image):
         '''Grab size of loaded images.'''
         self.set_image(image)
-        self.origSize = self.imageLabel.pixmap().size()
+        self.origSize = QtCore.QSize(self.imageSize)
         self.resizeEvent(None) # Necessary to show initial image with correct size
 
-    def set_image(self, image):
-        '''Set the current image'''
-        # FIXME: the conversion to QPixmap is done everytime
-        #        would it be better/faster to keep all pixmaps in memory?
-        pixmap = QtGui.QPixmap.fromImage(numpy2qimage.numpy2qimage(image))
+    def set_image(self, image, key=None, bitdepth=None, levels=None):
+        '''
+        Set the current image.
+        If a key is given, the converted image is kept in the pixmap cache
+        (in tiled mode, the image pyramid is kept instead, so the key should
+        not depend on the levels).
+        Levels (darkest,brightest) are applied during the conversion.
+        '''
+        if self.tiled:
+            pyramid = ImagePyramid(image, self.imageLabel.tileSize)
+            if key is not None:
+                self.pyramids[key] = pyramid
+                while len(self.pyramids) > self.maxPyramids:
+                    self.pyramids.popitem(last=False)
+            self.set_pyramid(pyramid, bitdepth, levels)
+            return
+        qimage = numpy2qimage.numpy2qimage(image, bitdepth, levels)
+        pixmap = QtGui.QPixmap.fromImage(qimage)
+        if key is not None:
+            self.pixmapCache.add(key, pixmap)
+        self.set_pixmap(pixmap)
+
+    def show_cached(self, key, bitdepth=None, levels=None):
+        '''
+        Show image from the pixmap cache. Returns False if not in the cache.
+        In tiled mode, bitdepth and levels are used to convert the tiles.
+        '''
+        if self.tiled:
+            pyramid = self.pyramids.pop(key, None)
+            if pyramid is None:
+                return False
+            self.pyramids[key] = pyramid
+            self.set_pyramid(pyramid, bitdepth, levels)
+            return True
+        pixmap = self.pixmapCache.get(key)
+        if pixmap is None:
+            return False
+        self.set_pixmap(pixmap)
+        return True
+
+    def clear_cache(self):
+        '''Discard converted images and image pyramids (e.g., after the data changed).'''
+        self.pixmapCache.clear()
+        self.pyramids.clear()
+
+    def set_pixmap(self, pixmap):
+        '''Set the current image from an already converted QPixmap'''
+        self.imageSize = pixmap.size()
         self.imageLabel.setPixmap(pixmap)
 
+    def set_pyramid(self, pyramid, bitdepth=None, levels=None):
+        '''Set the current image from an image pyramid (tiled mode)'''
+        (height, width) = pyramid.shape
+        self.imageSize = QtCore.QSize(width, height)
+        self.imageLabel.set_pyramid(pyramid, bitdepth, levels)
+
     def resizeEvent(self, event):
         super(ImageViewer, self).resizeEvent(event)
         if self.fitToWindow:
@@ -81,17 +145,17 @@ class ImageViewer(QtGui.QScrollArea):
     def fit_to_window(self):
         '''Resize the image to be the same width as the scroll area'''
         self.fitToWindow = True
-        if self.imageLabel.pixmap() is not None:
-            pixSize = self.imageLabel.pixmap().size()
+        if self.imageSize is not None:
+            pixSize = QtCore.QSize(self.imageSize)
             # FIXME: What factor to use (or pixels to subtract) to use the full window?
             pixSize.scale(self.size()*.995, QtCore.Qt.KeepAspectRatio)
             self.scaleFactor = float(pixSize.width())/float(self.origSize.width())            
             self.imageLabel.setFixedSize(pixSize)
           
     def scale_image(self, factor):
-        if self.imageLabel.pixmap() is not None:
+        if self.imageSize is not None:
             self.scaleFactor *= factor;
-            self.imageLabel.resize(self.scaleFactor * self.imageLabel.pixmap().size());
+            self.imageLabel.resize(self.scaleFactor * self.imageSize);
             self.adjust_scroll_bars(factor) # To keep centered when zooming
        
     def adjust_scroll_bars(self, factor):
@@ -136,3 +200,169 @@ class ImageViewer(QtGui.QScrollArea):
             event.ignore()
         '''
         #self.emit(SIGNAL('scroll(int)'), ev.delta())
+
+
+class TiledImageWidget(QtGui.QWidget):
+    def __init__(self, tilesize=512, cachebytes=128*2**20, parent=None):
+        '''
+        Widget that paints an image from tiles of an image pyramid.
+
+        Only tiles that intersect the area being repainted are converted and drawn,
+        taken from the pyramid level that matches the current size of the widget,
+        so the cost of panning and zooming depends on the viewport, not the image size.
+        '''
+        super(TiledImageWidget, self).__init__(parent)
+        self.tileSize = tilesize
+        self.tileCache = PixmapCache(cachebytes)
+        self.pyramid = None
+        self.bitDepth = None
+        self.levels = None
+
+    def set_pyramid(self, pyramid, bitdepth=None, levels=None):
+        if (pyramid is not self.pyramid) or (bitdepth, levels) != (self.bitDepth, self.levels):
+            self.tileCache.clear()
+        self.pyramid = pyramid
+        self.bitDepth = bitdepth
+        self.levels = levels
+        self.update()
+
+    def get_tile(self, level, row, col):
+        '''Return QPixmap for one tile of one level of the pyramid'''
+        key = (level, row, col)
+        pixmap = self.tileCache.get(key)
+        if pixmap is None:
+            levelImage = self.pyramid.get_level(level)
+            tileSize = self.tileSize
+            tile = levelImage[row*tileSize:(row+1)*tileSize, col*tileSize:(col+1)*tileSize]
+            qimage = numpy2qimage.numpy2qimage(tile, self.bitDepth, self.levels)
+            pixmap = QtGui.QPixmap.fromImage(qimage)
+            self.tileCache.add(key, pixmap)
+        return pixmap
+
+    def paintEvent(self, event):
+        if self.pyramid is None:
+            return
+        (height, width) = self.pyramid.shape
+        level = self.pyramid.level_for_scale(min(self.width()/float(width),
+                                                 self.height()/float(height)))
+        (levelHeight, levelWidth) = self.pyramid.get_level(level).shape
+        # -- Size on screen of one pixel of this level --
+        scaleX = self.width()/float(levelWidth)
+        scaleY = self.height()/float(levelHeight)
+        tileSize = self.tileSize
+        rect = event.rect()
+        firstCol = max(0, int(rect.left()/(scaleX*tileSize)))
+        lastCol = min((levelWidth-1)//tileSize, int(rect.right()/(scaleX*tileSize)))
+        firstRow = max(0, int(rect.top()/(scaleY*tileSize)))
+        lastRow = min((levelHeight-1)//tileSize, int(rect.bottom()/(scaleY*tileSize)))
+        painter = QtGui.QPainter(self)
+        painter.setRenderHint(QtGui.QPainter.SmoothPixmapTransform)
+        for row in range(firstRow, lastRow+1):
+            for col in range(firstCol, lastCol+1):
+                pixmap = self.get_tile(level, row, col)
+                target = QtCore.QRectF(col*tileSize*scaleX, row*tileSize*scaleY,
+                                       pixmap.width()*scaleX, pixmap.height()*scaleY)
+                painter.drawPixmap(target, pixmap, QtCore.QRectF(pixmap.rect()))
+        painter.end()
+
+
+class ImagePyramid(object):
+    def __init__(self, image, minsize=512):
+        '''
+        Multi-resolution version of an image for display.
+        Each level is half the size of the previous one, and it is only
+        calculated the first time it is needed.
+
+        PARAMETERS:
+        image: [np.ndarray] 2D image (level 0).
+        minsize: [int] the coarsest level fits in minsize x minsize pixels.
+        '''
+        self.shape = image.shape
+        self.levels = [image]
+        self.nLevels = 1
+        (height, width) = image.shape
+        while max(height, width) > minsize:
+            (height, width) = (height//2, width//2)
+            self.nLevels += 1
+
+    def get_level(self, level):
+        while len(self.levels) <= level:
+            self.levels.append(downsample_by_two(self.levels[-1]))
+        return self.levels[level]
+
+    def level_for_scale(self, scale):
+        '''Return the coarsest level with at least one pixel per screen pixel'''
+        if scale >= 1:
+            return 0
+        return min(int(np.log2(1.0/scale)), self.nLevels-1)
+
+
+def downsample_by_two(image, blockrows=256):
+    '''
+    Halve the size of an image by averaging blocks of 2x2 pixels.
+    The image is processed in strips of 2*blockrows rows, so only one strip at a
+    time is converted to float32 (the result has the type of the image).
+    '''
+    (height, width) = (image.shape[0]//2*2, image.shape[1]//2*2)
+    smaller = np.empty((height//2, width//2), dtype=image.dtype)
+    for start in range(0, height, 2*blockrows):
+        strip = image[start:min(start+2*blockrows, height), :width]
+        total = strip[0::2, 0::2].astype(np.float32)
+        total += strip[0::2, 1::2]
+        total += strip[1::2, 0::2]
+        total += strip[1::2, 1::2]
+        total *= 0.25
+        if image.dtype.kind in 'ui':
+            np.round(total, out=total)
+        smaller[start//2:start//2+len(total)] = total
+    return smaller
+
+
+class PixmapCache(object):
+    def __init__(self, maxbytes):
+        '''
+        Keep QPixmaps in memory up to a budget of bytes.
+        When full, the least recently used pixmaps are discarded.
+        '''
+        self.maxBytes = maxbytes
+        self.nBytes = 0
+        self._pixmaps = collections.OrderedDict() # Ordered from least to most recently used
+
+    def __contains__(self, key):
+        return key in self._pixmaps
+
+    def __len__(self):
+        return len(self._pixmaps)
+
+    def get(self, key):
+        '''Return pixmap (or None if not in the cache)'''
+        pixmap = self._pixmaps.pop(key, None)
+        if pixmap is not None:
+            self._pixmaps[key] = pixmap
+        return pixmap
+
+    def add(self, key, pixmap):
+        '''Add pixmap and discard old ones if the budget is exceeded'''
+        self.remove(key)
+        pixmapBytes = pixmap_nbytes(pixmap)
+        if pixmapBytes > self.maxBytes:
+            return
+        while self.nBytes + pixmapBytes > self.maxBytes:
+            (oldKey, oldPixmap) = self._pixmaps.popitem(last=False)
+            self.nBytes -= pixmap_nbytes(oldPixmap)
+        self._pixmaps[key] = pixmap
+        self.nBytes += pixmapBytes
+
+    def remove(self, key):
+        pixmap = self._pixmaps.pop(key, None)
+        if pixmap is not None:
+            self.nBytes -= pixmap_nbytes(pixmap)
+
+    def clear(self):
+        self._pixmaps.clear()
+        self.nBytes = 0
+
+
+def pixmap_nbytes(pixmap):
+    '''Approximate memory used by a QPixmap'''
+    return pixmap.width() * pixmap.height() * max(pixmap.depth(), 8) // 8
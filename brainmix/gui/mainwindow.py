@@ -9,23 +9,36 @@ from PySide import QtCore
 from PySide import QtGui
 from . import histogram
 from . import imageviewer
+from . import prefetch
+from . import numpy2qimage
 
 class MainWindow(QtGui.QMainWindow):
     # -- Create signals --
     #updateImage = QtCore.Signal(int) # Send the image index
     #setRegistrationMethod = QtCore.Signal(int) # Set registration method by index
 
-    def __init__(self, session=None, parent=None):
-        '''Main window that holds all GUI pieces.'''
+    def __init__(self, session=None, parent=None, tiled=False):
+        '''
+        Main window that holds all GUI pieces.
+
+        PARAMETERS:
+        session: [core.session.Session] data and parameters of the session.
+        tiled: [Boolean] show images with tiled multi-resolution rendering.
+        '''
         super(MainWindow, self).__init__(parent)
 
         # -- Functional members --
         self.session = session
         self.regActionGroup = QtGui.QActionGroup(self) # Registration actions 
+        self.regWorker = None # Thread running the registration
         self.fitAtStart = True # Fit image to window at start (or not)
+        self.browseDirection = 1 # Last step through the stack (+1 or -1)
+        self.prefetchDepth = 3 # Number of images to prepare ahead of the current one
+        self.prefetcher = prefetch.SlicePrefetcher(self.make_qimage, parent=self)
+        self.prefetcher.sliceReady.connect(self.store_prefetched)
 
         # -- Widget members --
-        self.imageViewer = imageviewer.ImageViewer(self, fit=self.fitAtStart)
+        self.imageViewer = imageviewer.ImageViewer(self, fit=self.fitAtStart, tiled=tiled)
         self.imhist = histogram.HistogramEditor() # If parent=self, it will be non-window child
         
         # -- Intialize graphical interface --
@@ -43,7 +56,11 @@ class MainWindow(QtGui.QMainWindow):
 
     def change_levels(self,lowbound,highbound):
         self.session.change_levels((lowbound,highbound))
-        self.set_image()
+        # -- Display keys include the levels, so cached pixmaps need not be cleared (old --
+        # -- levels are evicted by the cache budget). Only pending prefetches are outdated. --
+        # -- Image pyramids (tiled mode) do not depend on the levels, only their tiles do. --
+        self.prefetcher.invalidate()
+        self.set_image(prefetch=False) # Keep the GUI responsive while dragging sliders
 
     def update_title(self):
         nImages = len(self.session.filenames)
@@ -67,13 +84,49 @@ class MainWindow(QtGui.QMainWindow):
         layout.addWidget(self.imageViewer)
         self.setCentralWidget(mainWidget)
 
-    def set_image(self):
+    def set_image(self, prefetch=True):
         '''Set the current image.'''
-        if self.showAlignedAct.isChecked():
-            self.imageViewer.set_image(self.session.get_current_image(aligned=True))
+        aligned = self.showAlignedAct.isChecked()
+        currentInd = self.session.currentImageInd
+        bitDepth = self.session.origImages.bitDepth
+        if self.imageViewer.tiled:
+            key = self.session.get_data_key(currentInd, aligned) # Levels are applied per tile
         else:
-            self.imageViewer.set_image(self.session.get_current_image())
+            key = self.session.get_display_key(currentInd, aligned)
+        if not self.imageViewer.show_cached(key, bitDepth, self.session.levels):
+            self.imageViewer.set_image(self.session.get_image(currentInd, aligned), key,
+                                       bitDepth, self.session.levels)
         self.update_title()
+        if prefetch:
+            self.prefetch_neighbors(aligned)
+
+    def make_qimage(self, key):
+        '''Convert the image identified by a display key (see Session.get_display_key).'''
+        (stackID, imageInd, aligned, levels) = key
+        return numpy2qimage.numpy2qimage(self.session.get_image(imageInd, aligned),
+                                         self.session.origImages.bitDepth, levels)
+
+    def prefetch_neighbors(self, aligned):
+        '''Ask the prefetcher for the images most likely to be shown next.'''
+        if self.imageViewer.tiled:
+            return # Tiles are converted only when visible
+        neighbors = prefetch.neighbor_indices(self.session.currentImageInd,
+                                              self.session.origImages.nImages,
+                                              self.browseDirection, self.prefetchDepth)
+        wantedKeys = [self.session.get_display_key(ind, aligned) for ind in neighbors]
+        self.prefetcher.request([key for key in wantedKeys
+                                 if key not in self.imageViewer.pixmapCache])
+
+    @QtCore.Slot(int, object, object)
+    def store_prefetched(self, generation, key, qimage):
+        '''Keep an image prepared by the prefetcher (if it is still valid).'''
+        if generation == self.prefetcher.generation:
+            self.imageViewer.pixmapCache.add(key, QtGui.QPixmap.fromImage(qimage))
+
+    def invalidate_pixmaps(self):
+        '''Discard converted images and image pyramids (e.g., after the data changed).'''
+        self.prefetcher.invalidate()
+        self.imageViewer.clear_cache()
 
     def create_menus(self):
         '''Create the application menus.'''
@@ -81,8 +134,10 @@ class MainWindow(QtGui.QMainWindow):
         
         # -- File Menu --
         fileMenu = menubar.addMenu('&File')
-        openFilesAction = fileMenu.addAction('&Open images',self.open_images_dialog)
-        openFilesAction.setShortcut('Ctrl+O')
+        self.openFilesAct = fileMenu.addAction('&Open images',self.open_images_dialog)
+        self.openFilesAct.setShortcut('Ctrl+O')
+        self.saveTransformsAct = fileMenu.addAction('&Save transforms',self.save_transforms_dialog)
+        self.saveTransformsAct.setEnabled(False)
         exitAction = fileMenu.addAction('&Quit',self.close)
         exitAction.setShortcut('Ctrl+Q')
 
@@ -140,11 +195,51 @@ class MainWindow(QtGui.QMainWindow):
     
     @QtCore.Slot()
     def slot_register(self):
-        '''Slot for image registration'''
-        self.session.register_stack()
-        self.set_image()
-        self.showAlignedAct.setEnabled(True)
+        '''Slot for image registration (it runs on a separate thread)'''
+        # -- Actions that change the data are disabled until the registration finishes --
+        self.set_registration_controls(False)
+        self.statusBar().showMessage('Registering images...')
+        # -- Results go to a new stack (allocated here), swapped in when the thread finishes --
+        alignedImages = self.session.new_aligned_stack()
+        self.regWorker = RegistrationWorker(self.session, alignedImages, parent=self)
+        self.regWorker.progress.connect(self.show_registration_progress)
+        self.regWorker.failed.connect(self.slot_registration_failed)
+        self.regWorker.finished.connect(self.slot_registration_done)
+        self.regWorker.start()
+
+    def set_registration_controls(self, enabled):
+        '''Enable or disable the actions that cannot be used while registering'''
+        self.inSubjectAct.setEnabled(enabled)
+        self.openFilesAct.setEnabled(enabled)
+        self.regActionGroup.setEnabled(enabled)
+        self.showAlignedAct.setEnabled(enabled and self.session.aligned)
+
+    @QtCore.Slot(int,int)
+    def show_registration_progress(self, nDone, nTotal):
+        self.statusBar().showMessage('Registering images... ({0}/{1})'.format(nDone,nTotal))
+
+    @QtCore.Slot(str)
+    def slot_registration_failed(self, message):
+        '''Slot executed when the registration thread raises an error'''
+        self.statusBar().showMessage('Registration failed: {0}'.format(message))
+
+    @QtCore.Slot()
+    def slot_registration_done(self):
+        '''Slot executed when the registration thread finishes'''
+        regWorker = self.regWorker
+        self.regWorker = None
+        if not regWorker.succeeded:
+            # -- Keep the previous aligned images (if any) --
+            regWorker.alignedImages.release()
+            self.set_registration_controls(True)
+            return
+        self.session.set_registration(regWorker.alignedImages, regWorker.transforms)
+        self.statusBar().showMessage('Registration done.', 5000)
+        self.set_registration_controls(True)
+        self.invalidate_pixmaps()
         self.showAlignedAct.setChecked(True)
+        self.set_image()
+        self.saveTransformsAct.setEnabled(self.session.transforms is not None)
 
     @QtCore.Slot()
     def slot_switch_reg_methods(self):
@@ -171,17 +266,31 @@ class MainWindow(QtGui.QMainWindow):
 
     def update_histogram(self):
         '''Estimate and update histogram.'''
+        if not self.imhist.isVisible():
+            return
         currentImage = self.session.get_current_image()
-        bitDepth = self.session.origImages.bitDepth
-        self.imhist.set_data(currentImage,2**bitDepth)
+        origImages = self.session.origImages
+        nBins = 2**origImages.bitDepth
+        self.imhist.set_stack(origImages.stackID,origImages.images,nBins)
+        self.imhist.set_data(currentImage,nBins,self.session.currentImageInd)
 
     def open_images_dialog(self):
         '''Brings up a file chooser.'''
         files, filtr = QtGui.QFileDialog.getOpenFileNames(self,'Select Input Images',
                                                           '/tmp/','Image Files(*)')
         self.session.open_images(files)
+        self.saveTransformsAct.setEnabled(False)
+        self.invalidate_pixmaps()
         self.imageViewer.initialize(self.session.get_current_image())
 
+    def save_transforms_dialog(self):
+        '''Brings up a file chooser to save the registration transforms.'''
+        filename, filtr = QtGui.QFileDialog.getSaveFileName(self,'Save Transforms',
+                                                            '/tmp/transforms.txt','Text Files(*.txt)')
+        if filename:
+            self.session.save_transforms(filename)
+            self.statusBar().showMessage('Transforms saved to {0}'.format(filename), 5000)
+
     def closeEvent(self, event):
         '''
         Executed when closing the main window.
@@ -189,6 +298,10 @@ class MainWindow(QtGui.QMainWindow):
         its camelCase naming.
         '''
         self.imhist.close()
+        self.imhist.stop_stack_histogram()
+        self.prefetcher.stop()
+        if self.regWorker is not None:
+            self.regWorker.wait()
         event.accept()
           
     def keyPressEvent(self, event):
@@ -197,13 +310,46 @@ class MainWindow(QtGui.QMainWindow):
         '''
         key = event.key()
         if key == QtCore.Qt.Key_Left:
+            self.browseDirection = -1
             self.session.decrement_current_image()
             self.set_image()
             # FIXME: maybe this should send a signal (e.g., to update histogram)
             #self.updateImage.emit()
             self.update_histogram()
         elif key == QtCore.Qt.Key_Right:
+            self.browseDirection = 1
             self.session.increment_current_image()
             self.set_image()
             self.update_histogram()
         event.accept()
+
+
+class RegistrationWorker(QtCore.QThread):
+    # -- Send (nDone, nTotal) while registering --
+    progress = QtCore.Signal(int,int)
+    # -- Send an error message if the registration fails --
+    failed = QtCore.Signal(str)
+
+    def __init__(self, session, alignedImages, parent=None):
+        '''
+        Thread that registers the images of a session without blocking the GUI.
+        The session is not changed: results are stored in alignedImages and
+        self.transforms, to be set in the session from the GUI thread.
+
+        PARAMETERS:
+        session: [core.session.Session] session with the images to register.
+        alignedImages: [core.data.ImageStack] stack for the results (see Session.new_aligned_stack).
+        '''
+        super(RegistrationWorker, self).__init__(parent)
+        self.session = session
+        self.alignedImages = alignedImages
+        self.transforms = None
+        self.succeeded = False
+
+    def run(self):
+        try:
+            self.transforms = self.session.compute_registration(self.alignedImages,
+                                                                progress=self.progress.emit)
+            self.succeeded = True
+        except Exception as exc:
+            self.failed.emit(str(exc) or exc.__class__.__name__)
@@ -6,15 +6,71 @@ http://femr.googlecode.com/hg-history/e06e4336439755f075dc693acaffb72093fd8c45/s
 import numpy as numpy
 from PySide import QtGui
 
+# -- Grayscale color table shared by all 8-bit images --
+GRAY_COLORTABLE = [0xff000000 | (i<<16) | (i<<8) | i for i in range(256)]
+
+# -- Default bit depth assumed for each type of data --
+# NOTE: 16bit and float images are assumed to have 12bit resolution (true for LISB scope)
+DEFAULT_BITDEPTH = {'u':{1:8, 2:12}, 'f':12}
+
+_lutCache = {}
+
 # -- Convert from ndarray to QImage --
-def numpy2qimage(array):
+def numpy2qimage(array, bitdepth=None, levels=None):
     if numpy.ndim(array) == 2:
-        return gray2qimage(array)
+        return gray2qimage(array, bitdepth, levels)
     elif numpy.ndim(array) == 3:
         return rgb2qimage(array)
     raise ValueError("can only convert 2D or 3D arrays")
 
-def gray2qimage(gray):
+def gray_lut(nentries, bitdepth, levels=None):
+    '''
+    Lookup table (uint8) that maps pixel values to display values.
+
+    Args:
+        nentries (int): number of entries (one for each possible pixel value).
+        bitdepth (int): bit depth of the data (e.g., 12 for 12bit images in 16bit arrays).
+        levels (tuple): (darkest, brightest) pixel values shown as black and white.
+            If None, the full range given by the bit depth is used.
+    '''
+    # NOTE: this runs on the GUI and prefetcher threads, so the cache may be cleared
+    #       by the other thread at any time (the table is kept in a local variable).
+    key = (nentries, bitdepth, levels)
+    lut = _lutCache.get(key)
+    if lut is None:
+        if levels is None:
+            levels = (0, 2**bitdepth-1)
+        (low, high) = levels
+        scale = 256.0/max(high-low+1, 1)
+        values = (numpy.arange(nentries) - low) * scale
+        lut = numpy.clip(values, 0, 255).astype(numpy.uint8)
+        if len(_lutCache) > 32:
+            _lutCache.clear() # Levels change often while dragging sliders
+        _lutCache[key] = lut
+    return lut
+
+def gray2display(gray, bitdepth=None, levels=None):
+    '''
+    Map a 2D array (uint8, uint16 or float) to display values (uint8) using a lookup table.
+    Float images are quantized to 2**bitdepth values before the lookup.
+    '''
+    if bitdepth is None:
+        if gray.dtype.kind == 'u':
+            bitdepth = DEFAULT_BITDEPTH['u'].get(gray.dtype.itemsize, 12)
+        else:
+            bitdepth = DEFAULT_BITDEPTH['f']
+    if gray.dtype == numpy.uint8:
+        if levels is None and bitdepth == 8:
+            return numpy.require(gray, numpy.uint8, 'C')
+        return gray_lut(256, bitdepth, levels).take(gray)
+    elif gray.dtype == numpy.uint16:
+        return gray_lut(2**16, bitdepth, levels).take(gray)
+    else:
+        nentries = 2**bitdepth
+        indices = numpy.clip(gray, 0, nentries-1).astype(numpy.uint16)
+        return gray_lut(nentries, bitdepth, levels).take(indices)
+
+def gray2qimage(gray, bitdepth=None, levels=None):
     '''
     Convert numpy array to QtImage
     '''
@@ -22,32 +78,10 @@ def gray2qimage(gray):
         raise ValueError("gray2QImage can only convert 2D arrays")
 
     h, w = gray.shape
-    if gray.dtype == numpy.uint8:
-        gray = numpy.require(gray, numpy.uint8, 'C')
-        result = QtGui.QImage(gray.data, w, h, QtGui.QImage.Format_Indexed8)
-        result.ndarray = gray
-        for i in range(256):
-            result.setColor(i, QtGui.QColor(i, i, i).rgb())
-    elif gray.dtype == numpy.uint16:
-        # This assumes that a 16bit image is only 12bit resolution: 2^16-2^12=16
-        gray = (gray/16).astype(numpy.uint8)
-        gray = numpy.require(gray, numpy.uint8, 'C')
-        h, w = gray.shape
-        result = QtGui.QImage(gray.data, w, h, QtGui.QImage.Format_Indexed8)
-        result.ndarray = gray
-        #for i in range(256):
-        #    result.setColor(i, QtGui.QColor(i, i, i).rgb())
-    else:
-        # Convert by multiplying by 256 and making it uint8
-        #print gray * 2**(8-12)
-        #gray = (gray * 256).astype(numpy.uint8)
-        gray = (gray * 2**(8-12)).astype(numpy.uint8)
-        gray = numpy.require(gray, numpy.uint8, 'C')
-        h, w = gray.shape
-        result = QtGui.QImage(gray.data, w, h, QtGui.QImage.Format_Indexed8)
-        result.ndarray = gray
-        for i in range(256):
-            result.setColor(i, QtGui.QColor(i, i, i).rgb())
+    gray = gray2display(gray, bitdepth, levels)
+    result = QtGui.QImage(gray.data, w, h, w, QtGui.QImage.Format_Indexed8)
+    result.ndarray = gray
+    result.setColorTable(GRAY_COLORTABLE)
     return result
 
 
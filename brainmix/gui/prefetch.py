@@ -0,0 +1,83 @@
+'''
+Background preparation of images that will likely be shown next.
+
+Please see the AUTHORS file for credits.
+'''
+
+from PySide import QtCore
+
+class SlicePrefetcher(QtCore.QThread):
+    # -- Send (generation, key, QImage) when an image is ready --
+    sliceReady = QtCore.Signal(int, object, object)
+
+    def __init__(self, make_qimage, parent=None):
+        '''
+        Worker thread that decodes images and converts them to QImage.
+
+        QPixmap objects can only be created in the GUI thread, so the worker
+        prepares a QImage and the receiver of sliceReady converts it to a
+        QPixmap (which is a fast copy).
+
+        PARAMETERS:
+        make_qimage: [function] called as make_qimage(key) to obtain a QImage.
+        '''
+        super(SlicePrefetcher, self).__init__(parent)
+        self.make_qimage = make_qimage
+        self.generation = 0 # Incremented when the underlying data changes
+        self._pending = []
+        self._stopping = False
+        self._mutex = QtCore.QMutex()
+        self._condition = QtCore.QWaitCondition()
+
+    def request(self, keys):
+        '''Replace the list of pending images (older requests are dropped)'''
+        self._mutex.lock()
+        self._pending = list(keys)
+        self._condition.wakeOne()
+        self._mutex.unlock()
+        if not self.isRunning():
+            self.start(QtCore.QThread.LowPriority)
+
+    def invalidate(self):
+        '''Drop pending requests and mark images being prepared as outdated'''
+        self._mutex.lock()
+        self._pending = []
+        self.generation += 1
+        self._mutex.unlock()
+
+    def stop(self):
+        '''Finish the worker thread'''
+        self._mutex.lock()
+        self._stopping = True
+        self._condition.wakeOne()
+        self._mutex.unlock()
+        self.wait()
+
+    def run(self):
+        while True:
+            self._mutex.lock()
+            while not self._pending and not self._stopping:
+                self._condition.wait(self._mutex)
+            if self._stopping:
+                self._mutex.unlock()
+                return
+            key = self._pending.pop(0)
+            generation = self.generation
+            self._mutex.unlock()
+            qimage = self.make_qimage(key)
+            self.sliceReady.emit(generation, key, qimage)
+
+
+def neighbor_indices(currentInd, nImages, direction, depth):
+    '''
+    Return indices of images likely to be shown next, most likely first.
+    It looks 'depth' images ahead in the browsing direction and one image behind.
+    '''
+    direction = 1 if direction >= 0 else -1
+    steps = [direction*step for step in range(1, depth+1)] + [-direction]
+    indices = []
+    for step in steps:
+        ind = (currentInd + step) % nImages
+        if ind != currentInd and ind not in indices:
+            indices.append(ind)
+    return indices
@@ -19,7 +19,6 @@ import numpy as np
 from numpy import math
 from brainmix.modules import imregistration as imreg
 import skimage.transform
-import scipy.signal
 
 def affine_transform(image, tfrm):
     '''
@@ -37,7 +36,56 @@ def affine_transform(image, tfrm):
     return outimg
 
 
-def affine_least_squares(source, target, tfrm, maxIterations):
+def affine_target_terms(target, tgrad=None, samples=None):
+    '''
+    Values used by affine_least_squares() that depend only on the target image.
+
+    The steepest-descent images (target gradient times the derivative of the warp with respect
+    to each of the 6 affine parameters) are stacked as the columns of a [nPixels,6] matrix, so the
+    Hessian is a single matrix product.
+
+    Args:
+        target (np.ndarray): target image.
+        tgrad (np.ndarray): (optional) gradient of the target, from imreg.image_gradient().
+        samples (np.ndarray): (optional) flat indices of the pixels to use (default: all).
+
+    Returns:
+        targetTerms (tuple): (steepest, tHessian), with steepest of shape [nPixels,6]
+            (or [nSamples,6]) for the parameters (a00, a01, a02, a10, a11, a12).
+    '''
+    (height, width) = target.shape
+    if tgrad is None:
+        tgrad = imreg.image_gradient(target)
+    (gx, gy) = tgrad
+    if samples is None:
+        xcoords = np.arange(width, dtype=gx.dtype)
+        ycoords = np.arange(height, dtype=gx.dtype)[:,np.newaxis]
+        imshape = (height, width)
+    else:
+        (gx, gy) = (gx.ravel()[samples], gy.ravel()[samples])
+        xcoords = (samples % width).astype(gx.dtype)
+        ycoords = (samples // width).astype(gx.dtype)
+        imshape = gx.shape
+    # -- Fortran order keeps each column contiguous (and steepest.T in C order for BLAS) --
+    steepest = np.empty((gx.size, 6), dtype=gx.dtype, order='F')
+    columns = [steepest[:,ind].reshape(imshape) for ind in range(6)]
+    np.multiply(gx, xcoords, out=columns[0])
+    np.multiply(gx, ycoords, out=columns[1])
+    columns[2][...] = gx
+    np.multiply(gy, xcoords, out=columns[3])
+    np.multiply(gy, ycoords, out=columns[4])
+    columns[5][...] = gy
+    # -- The Hessian is accumulated in double precision, converting a block of rows at a time --
+    tHessian = np.zeros((6, 6))
+    blockSize = 65536
+    for start in range(0, len(steepest), blockSize):
+        block = steepest[start:start+blockSize].astype(np.float64)
+        tHessian += np.dot(block.T, block)
+    return (steepest, tHessian)
+
+
+def affine_least_squares(source, target, tfrm, maxIterations, targetTerms=None, warper=None,
+                         samples=None, convergence=None, layer=None):
     '''
     Apply modified Levenberg-Marquardt algorithm to minimize the difference in pixel
     intensities between the source and target images.
@@ -47,6 +95,12 @@ def affine_least_squares(source, target, tfrm, maxIterations):
         target (np.ndarray): target image, the one that will not move.
         tfrm (np.ndarray): (3,3) initial transformation [homogeneous affine transformation matrix].
         maxIterations (int): maximum number of iterations performed by algorithm before returning a transformation
+        targetTerms (tuple): (optional) precalculated affine_target_terms(target).
+        warper (imreg.SplineWarper): (optional) warper for the source image.
+        samples (np.ndarray): (optional) flat indices of the pixels to compare (default: all).
+            The same samples must be used for targetTerms and warper.
+        convergence (imreg.ConvergenceController): (optional) rules to stop iterating.
+        layer (int): (optional) pyramid level of the images (only recorded by convergence).
 
     Returns:
         tfrm (np.ndarray): (3,3) best transformation.
@@ -57,91 +111,148 @@ def affine_least_squares(source, target, tfrm, maxIterations):
     imshape = source.shape
     (height, width) = imshape
     newtfrm = tfrm - topidentity
-    lambdavar = 1.0
-    # -- Use Scharr operator to calculate image gradient in horizontal and vertical directions --
-    scharr = np.array([[-3-3j, 0-10j, +3-3j], [-10+0j, 0+0j, +10+0j], [-3+3j, 0+10j, +3+3j]])
-    tgrad = scipy.signal.convolve2d(target, scharr, boundary='symm', mode='same')
+    if convergence is None:
+        convergence = imreg.ConvergenceController()
+    # -- Image gradient (Scharr operator) and Hessian depend only on the target --
+    if targetTerms is None:
+        targetTerms = affine_target_terms(target, samples=samples)
+    (steepest, tHessian) = targetTerms
+    # -- The warper keeps what all iterations need (e.g., spline coefficients with samples) --
+    if warper is None:
+        warper = imreg.SplineWarper(source, dtype=target.dtype, samples=samples)
+    warped = np.empty(warper.outputShape, dtype=warper.dtype)
+    if samples is not None:
+        target = target.ravel()[samples]
     # -- Calculate current error --
-    err = target - affine_transform(source, tfrm)
-    bestMeanSquares = np.mean(err**2)
-    # -- Pre-calculate the Hessian --
-    xdx = tgrad.real*np.arange(width)
-    ydx = tgrad.real*np.arange(height)[:,np.newaxis]
-    xdy = tgrad.imag*np.arange(width)
-    ydy = tgrad.imag*np.arange(height)[:,np.newaxis]
+    err = target - warper.warp(tfrm, warped)
+    convergence.start(np.mean(err**2), maxIterations, 'affine', layer)
     (heightSq,widthSq) = np.array(imshape)**2
-    displacement = 1.0
-    tHessian = np.array([[np.sum(xdx**2), np.sum(xdx*ydx), np.sum(xdx*tgrad.real), np.sum(xdx*xdy), np.sum(xdx*ydy), np.sum(xdx*tgrad.imag)],
-                         [0, np.sum(ydx**2), np.sum(ydx*tgrad.real), np.sum(ydx*xdy), np.sum(ydx*ydy), np.sum(ydx*tgrad.imag)],
-                         [0, 0, np.sum(tgrad.real**2), np.sum(tgrad.real*xdy), np.sum(tgrad.real*ydy), np.sum(tgrad.real*tgrad.imag)],
-                         [0, 0, 0, np.sum(xdy**2), np.sum(xdy*ydy), np.sum(xdy*tgrad.imag)],
-                         [0, 0, 0, 0, np.sum(ydy**2), np.sum(ydy*tgrad.imag)],
-                         [0, 0, 0, 0, 0, np.sum(tgrad.imag**2)]])
-    tHessian += np.triu(tHessian,1).T
-    # NOTE: using range() for compatibility with Python3
-    for iteration in range(int(maxIterations)):
-        gradient = np.array([np.sum(err*xdx),
-                             np.sum(err*ydx),
-                             np.sum(err*tgrad.real),
-                             np.sum(err*xdy),
-                             np.sum(err*ydy), 
-                             np.sum(err*tgrad.imag)])
-        tHessianDiag = np.diag(lambdavar*np.diag(tHessian))
+    # -- The gradient is evaluated at the best transformation so far (rejected steps keep it) --
+    gradient = np.dot(steepest.T, err.ravel())
+    while not convergence.finished:
+        tHessianDiag = np.diag(convergence.lambdavar*np.diag(tHessian))
         # -- update is inverted and composed with current best attempt --
-        updateinv = np.dot(np.linalg.inv(tHessian+tHessianDiag),gradient).reshape(2,3)
+        updateinv = np.linalg.solve(tHessian+tHessianDiag, gradient).reshape(2,3)
         updateinv = np.vstack((updateinv, np.array([0,0,1])))+topidentity
         update = np.linalg.inv(updateinv)
         newtfrmfull = newtfrm+topidentity
         attempt = np.dot(newtfrmfull,update)
         displacement = np.sqrt(update[0,2]*update[0,2] + update[1,2]*update[1,2]) + \
                        0.25 * np.sqrt(widthSq + heightSq) * np.sum(np.absolute(update[:2,:2]))
-        err = target - affine_transform(source, attempt)
-        if np.mean(err**2)<bestMeanSquares:
-            bestMeanSquares = np.mean(err**2)
+        err = target - warper.warp(attempt, warped)
+        if convergence.update(np.mean(err**2), displacement):
             newtfrm = attempt-topidentity
-            lambdavar /= 10.0 # FIXME: we may need to prevent lambda from becoming 0
-        else:
-            lambdavar *= 10.0
-        if displacement < 0.001:
-            break
+            gradient = np.dot(steepest.T, err.ravel())
     return newtfrm+topidentity
             
 
-def affine_registration(source, target, pyramidDepth, minLevel=0, downscale=2, debug=False):
+def affine_registration(source, target, pyramidDepth, minLevel=0, downscale=2, debug=False,
+                        dtype=None, sampling=None, convergence=None, init='com'):
     '''
     Find affine transformation that registers source image to the target image.
 
     This function computes the image pyramid for source and target and calculates the transformation
     that minimizes the least-square error between images (starting at the lowest resolution).
+    A rigid-body registration provides the initial guess (see rigid_affine_registration).
 
     Args:
         source (np.ndarray): source image, the one that will be transformed.
+            An imreg.PreparedTarget can be given instead to reuse its pyramid.
         target (np.ndarray): target image, the one that will not move.
+            An imreg.PreparedTarget can be given instead to reuse its pyramid, gradients and Hessians.
         pyramidDepth (int): number of pyramid levels, in addition to the original.
         minLevel (int): 0 for original level, >0 for coarser resolution.
+        dtype (np.dtype): (optional) np.float32 to register in single precision.
+            Default: np.float64, or the type of the PreparedTarget.
+        sampling (imreg.PixelSampling): (optional) compare images only on a subset of pixels
+            at fine levels.
+        convergence (imreg.ConvergenceController): (optional) iterations per level and stopping
+            rules, used for both the rigid-body initialization and the affine stage.
+        init (str): (optional) initial guess of the rigid-body stage, 'com' (centers of mass)
+            or 'fft' (Fourier-Mellin phase correlation, see imreg.rigid_body_registration).
     
     Return:
         tfrm (np.ndarray): (3,3) best transformation
     '''
-    sourcePyramid = tuple(skimage.transform.pyramid_gaussian(source, max_layer=pyramidDepth, downscale=downscale))
-    targetPyramid = tuple(skimage.transform.pyramid_gaussian(target, max_layer=pyramidDepth, downscale=downscale))
+    (tfrm, diagnostics) = rigid_affine_registration(source, target, pyramidDepth, minLevel,
+                                                    downscale, dtype, sampling, convergence, init)
+    if debug:
+        for level in diagnostics['history']:
+            print '{stage} layer {layer}: {iterations} iterations, MSE={meanSquares:0.4g}'.format(**level)
+    return tfrm
+
+
+def rigid_affine_registration(source, target, pyramidDepth, minLevel=0, downscale=2, dtype=None,
+                              sampling=None, convergence=None, init='com', affineLevels=None):
+    '''
+    Rigid-body registration followed by affine registration, sharing everything possible.
+
+    Both stages use the same pyramids, target gradients and spline coefficients of the source
+    (through imreg.PreparedTarget), so each of them is calculated once per level. The affine
+    stage starts from the rigid-body result and refines it on the finest levels.
+
+    Args:
+        source, target, pyramidDepth, minLevel, downscale, dtype, sampling, convergence, init:
+            see affine_registration.
+        affineLevels (int): (optional) number of levels above minLevel refined by the affine
+            stage. Default: all the levels used by the rigid-body stage. Fewer levels save
+            iterations when the rigid-body result is already close.
+
+    Returns:
+        tfrm (np.ndarray): (3,3) best affine transformation.
+        diagnostics (dict): 'rigid': (3,) rigid-body transformation found by the first stage,
+            'iterations' and 'meanSquares': {stage: value} for the finest level of each stage,
+            'history': iterations of each stage and level (see imreg.ConvergenceController).
+    '''
+    if dtype is None and isinstance(target, imreg.PreparedTarget):
+        dtype = target.dtype
+    if not isinstance(source, imreg.PreparedTarget):
+        source = imreg.PreparedTarget(source, pyramidDepth, downscale, dtype, minLevel)
+    if not isinstance(target, imreg.PreparedTarget):
+        target = imreg.PreparedTarget(target, pyramidDepth, downscale, dtype, minLevel)
+    sourcePyramid = source.pyramid
+    targetPyramid = target.pyramid
+    if convergence is None:
+        convergence = imreg.ConvergenceController()
     # -- compute small scale rigid body transformation to provide the initial guess for the affine transformation --
-    rtfrm = imreg.rigid_body_registration(sourcePyramid[minLevel], targetPyramid[minLevel], pyramidDepth-minLevel)
+    # -- (registering the same pyramids from pyramidDepth to minLevel, with translation in minLevel pixels) --
+    rigidtfrm = imreg.rigid_body_registration(source, target, pyramidDepth, minLevel, downscale,
+                                              sampling=sampling, convergence=convergence, init=init)
+    rtfrm = rigidtfrm.copy()
+    rtfrm[1:] /= pow(downscale,minLevel)
     rotmatrix = np.array([[math.cos(rtfrm[0]), -math.sin(rtfrm[0])], [math.sin(rtfrm[0]), math.cos(rtfrm[0])]])
     tfrm = np.append(rotmatrix, [[rtfrm[1]], [rtfrm[2]]], 1)
-    tfrm[:,-1] /= pow(downscale,pyramidDepth-minLevel)
+    if affineLevels is not None:
+        # -- refine the rigid-body result only on the finest levels --
+        startLayer = min(minLevel+affineLevels, pyramidDepth)
+    elif init == 'fft':
+        # -- start from the level where the FFT initialization was refined, since coarser levels --
+        # -- are too small for large rotations --
+        startLayer = imreg.fourier_mellin_layer(targetPyramid, pyramidDepth, minLevel)
+    else:
+        startLayer = pyramidDepth
+    # -- translation in startLayer pixels, divided once more since it is multiplied by downscale --
+    # -- at the beginning of each level below --
+    tfrm[:,-1] /= pow(downscale,startLayer-minLevel+1)
     tfrm = np.vstack((tfrm, [0,0,1]))
     #tfrm = np.array([[1,0,0],[0,1,0],[0,0,1]])
-    for layer in range(pyramidDepth, minLevel-1, -1):
+    for layer in range(startLayer, minLevel-1, -1):
         tfrm[:2,-1] *= downscale  # Scale translation for next level in pyramid
-        tfrm = affine_least_squares(sourcePyramid[layer],targetPyramid[layer], tfrm, 10*2**(layer-1))
+        (targetTerms, samples) = target.level_terms('affine', layer, affine_target_terms,
+                                                    sampling, minLevel)
+        warper = source.warper(layer, target.dtype, samples)
+        tfrm = affine_least_squares(sourcePyramid[layer],targetPyramid[layer], tfrm,
+                                    convergence.max_iterations(layer), targetTerms, warper,
+                                    samples, convergence, layer)
         toptfrm = np.concatenate((tfrm[:2,0:2],tfrm[:2,-1:]*pow(downscale,layer)), axis=1)
         toptfrm = np.vstack((toptfrm, np.array([0,0,1])))
-        if debug:
-            pass #some debugging stuff Santiago was using
-            #print 'Layer {0}: {1}x{2}'.format(layer, *targetPyramid[layer].shape)
-            #print 'th={0:0.4}, x={1:0.1f} , y={2:0.1f}'.format(*toptfrm) ### DEBUG
-    return toptfrm
+    # -- the last entries of the history are from the finest level of each stage --
+    finest = dict((level['stage'], level) for level in convergence.history)
+    diagnostics = {'rigid': rigidtfrm,
+                   'iterations': dict((stage, level['iterations']) for stage, level in finest.items()),
+                   'meanSquares': dict((stage, level['meanSquares']) for stage, level in finest.items()),
+                   'history': convergence.history}
+    return (toptfrm, diagnostics)
 
 
 
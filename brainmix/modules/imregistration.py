@@ -17,11 +17,15 @@ TO DO:
 '''
 
 
+import threading
+import itertools
+import collections
 import numpy as np
 import skimage.transform
-import scipy.signal
 import scipy.ndimage
 
+FOURIER_MELLIN_SIZE = 64 # Smallest image side used by the FFT initialization (in pixels)
+
 
 def rigid_body_transform(image, tfrm):
     '''
@@ -39,7 +43,729 @@ def rigid_body_transform(image, tfrm):
     return outimg
 
 
-def rigid_body_least_squares(source, target, tfrm, maxIterations):
+def rigid_body_matrix(tfrm):
+    '''
+    Homogeneous matrix of a rigid-body transformation (as used by rigid_body_transform).
+
+    Args:
+        tfrm (np.ndarray): (3,) transformation [rotation_angle, translation_x, translation_y].
+
+    Returns:
+        matrix (np.ndarray): (3,3) homogeneous transformation matrix.
+    '''
+    (cosTheta, sinTheta) = (np.cos(tfrm[0]), np.sin(tfrm[0]))
+    return np.array([[cosTheta, -sinTheta, tfrm[1]],
+                     [sinTheta,  cosTheta, tfrm[2]],
+                     [0, 0, 1.0]])
+
+
+def rigid_body_parameters(matrix):
+    '''
+    Rigid-body parameters of a homogeneous matrix (inverse of rigid_body_matrix).
+
+    Args:
+        matrix (np.ndarray): (3,3) homogeneous matrix of a rigid-body transformation.
+
+    Returns:
+        tfrm (np.ndarray): (3,) transformation [rotation_angle, translation_x, translation_y].
+    '''
+    return np.array([np.arctan2(matrix[1,0], matrix[0,0]), matrix[0,2], matrix[1,2]])
+
+
+class SplineWarper(object):
+    def __init__(self, image, order=3, mode='nearest', dtype=None, samples=None, coefficients=None):
+        '''
+        Resample one image many times with different transformations (e.g., in the LM loop).
+
+        Without samples, each warp() is a skimage.transform.warp (cubic convolution), the
+        same interpolation used for the final registered images (transforms.warp_image).
+        It is faster than scipy.ndimage.map_coordinates on the full grid with the installed
+        scikit-image. If samples are given, only those pixels of the output are calculated
+        (the result is a 1D array) with map_coordinates: the spline coefficients of the image
+        are calculated only once, and the buffers for the sampling coordinates are reused by
+        every call to warp().
+
+        Args:
+            image (np.ndarray): grayscale image to transform.
+            order (int): order of the spline interpolation.
+            mode (str): how to handle points outside the image (see scipy.ndimage.map_coordinates).
+            dtype (np.dtype): type of coefficients, coordinates and results (np.float32 or np.float64).
+                Default: float32 if the image is float32, float64 otherwise.
+            samples (np.ndarray): (optional) flat indices of the output pixels to calculate.
+            coefficients (np.ndarray): (optional) spline coefficients of the image, calculated
+                before with the same order and dtype (e.g., by another SplineWarper).
+        '''
+        self.order = order
+        self.mode = mode
+        self.shape = image.shape
+        self.dtype = np.dtype(working_dtype(image, dtype))
+        self.image = np.asarray(image, dtype=self.dtype)
+        self.samples = samples
+        self._coefficients = coefficients # Calculated when first needed (only with samples)
+        (height, width) = self.shape
+        if samples is None:
+            self.outputShape = self.shape
+        else:
+            self.outputShape = (len(samples),)
+            self._xcoords = (samples % width).astype(self.dtype)
+            self._ycoords = (samples // width).astype(self.dtype)
+            self._coords = np.empty((2,)+self.outputShape, dtype=self.dtype)
+
+    @property
+    def coefficients(self):
+        '''Spline coefficients of the image (used to interpolate at the sampled pixels)'''
+        if self._coefficients is None:
+            if self.order > 1:
+                self._coefficients = scipy.ndimage.spline_filter(self.image, order=self.order,
+                                                                 output=self.dtype)
+            else:
+                self._coefficients = self.image
+        return self._coefficients
+
+    def warp(self, matrix, output=None):
+        '''
+        Resample the image with an affine transformation.
+
+        Args:
+            matrix (np.ndarray): (3,3) homogeneous matrix that maps (x,y) coordinates of the
+                output to coordinates of the input (as in skimage.transform.warp).
+            output (np.ndarray): (optional) array where the result will be stored.
+
+        Returns:
+            outimg (np.ndarray): transformed image.
+        '''
+        if output is None:
+            output = np.empty(self.outputShape, dtype=self.dtype)
+        if self.samples is None:
+            output[...] = skimage.transform.warp(self.image, matrix, order=self.order, mode=self.mode)
+            return output
+        (rowCoords, colCoords) = self._coords
+        # -- Input row is y = m10*x + m11*y + m12, input column is x = m00*x + m01*y + m02 --
+        np.multiply(self._xcoords, matrix[1,0], out=rowCoords)
+        rowCoords += self._ycoords*matrix[1,1] + matrix[1,2]
+        np.multiply(self._xcoords, matrix[0,0], out=colCoords)
+        colCoords += self._ycoords*matrix[0,1] + matrix[0,2]
+        scipy.ndimage.map_coordinates(self.coefficients, self._coords, output=output,
+                                      order=self.order, mode=self.mode, prefilter=False)
+        return output
+
+
+class ConvergenceController(object):
+    def __init__(self, maxIterations=None, minDisplacement=0.001, stallTolerance=1e-5,
+                 stallIterations=2, maxRejected=5, lambdaStart=1.0, lambdaFactor=10.0,
+                 lambdaMin=1e-6, lambdaMax=1e6):
+        '''
+        Rules to stop the Levenberg-Marquardt iterations at each pyramid level.
+
+        The iterations of a level stop when:
+        - the update moves pixels less than minDisplacement,
+        - accepted steps improve the mean squared error by less than stallTolerance (relative)
+          for stallIterations consecutive steps,
+        - maxRejected consecutive steps do not improve the error, or a step is rejected when
+          lambda is already lambdaMax,
+        - the maximum number of iterations for the level is reached.
+        The damping factor lambda is divided (or multiplied) by lambdaFactor after each accepted
+        (or rejected) step, and kept between lambdaMin and lambdaMax.
+
+        Even with the default settings, results differ slightly from the loops used before this
+        controller (only iteration caps and minDisplacement, unbounded lambda, and a gradient
+        also taken after rejected steps): the stall and rejection stops end some levels earlier.
+        For example, affine translations on a 512x512 pair at minLevel 3 moved by up to 0.1 px.
+
+        The results of each level (stage, layer, iterations, meanSquares, reason) are appended
+        to self.history, so use one controller per registration (see copy()).
+
+        Args:
+            maxIterations: maximum iterations per level. An int (same for all levels), a dict
+                {layer: maxIterations}, or None for 10*2**(layer-1).
+            minDisplacement (float): smallest displacement (in pixels) worth another iteration.
+            stallTolerance (float): smallest relative improvement of the error worth continuing.
+            stallIterations (int): consecutive stalled steps before stopping.
+            maxRejected (int): consecutive rejected steps before stopping.
+            lambdaStart (float): initial damping factor at each level.
+            lambdaFactor (float): change of the damping factor after each step.
+            lambdaMin (float): smallest damping factor.
+            lambdaMax (float): largest damping factor.
+        '''
+        self.maxIterationsPerLevel = maxIterations
+        self.minDisplacement = minDisplacement
+        self.stallTolerance = stallTolerance
+        self.stallIterations = stallIterations
+        self.maxRejected = maxRejected
+        self.lambdaStart = lambdaStart
+        self.lambdaFactor = lambdaFactor
+        self.lambdaMin = lambdaMin
+        self.lambdaMax = lambdaMax
+        self.history = []
+        self.lambdavar = lambdaStart
+        self.finished = True
+
+    def copy(self):
+        '''Return a controller with the same rules and an empty history'''
+        return ConvergenceController(self.maxIterationsPerLevel, self.minDisplacement,
+                                     self.stallTolerance, self.stallIterations, self.maxRejected,
+                                     self.lambdaStart, self.lambdaFactor, self.lambdaMin,
+                                     self.lambdaMax)
+
+    def max_iterations(self, layer):
+        '''Maximum number of iterations for a level of the pyramid'''
+        if self.maxIterationsPerLevel is None:
+            return int(10*2**(layer-1))
+        elif isinstance(self.maxIterationsPerLevel, dict):
+            return int(self.maxIterationsPerLevel.get(layer, 10*2**(layer-1)))
+        return int(self.maxIterationsPerLevel)
+
+    def start(self, meanSquares, maxIterations, stage='', layer=None):
+        '''Reset the state before iterating on a new level, given the initial error'''
+        self.lambdavar = self.lambdaStart
+        self.bestMeanSquares = meanSquares
+        self.maxIterations = int(maxIterations)
+        self._nStalled = 0
+        self._nRejected = 0
+        self.current = {'stage':stage, 'layer':layer, 'iterations':0,
+                        'meanSquares':float(meanSquares), 'reason':'iterations'}
+        self.history.append(self.current)
+        self.finished = self.maxIterations <= 0
+
+    def update(self, meanSquares, displacement):
+        '''
+        Record the result of one iteration and update lambda and self.finished.
+        Returns True if the step is accepted (it reduced the error).
+        '''
+        self.current['iterations'] += 1
+        accepted = meanSquares < self.bestMeanSquares
+        if accepted:
+            improvement = (self.bestMeanSquares-meanSquares)/self.bestMeanSquares
+            self._nStalled = self._nStalled+1 if improvement < self.stallTolerance else 0
+            self._nRejected = 0
+            self.bestMeanSquares = meanSquares
+            self.current['meanSquares'] = float(meanSquares)
+            self.lambdavar = max(self.lambdavar/self.lambdaFactor, self.lambdaMin)
+        else:
+            self._nRejected += 1
+            atMaxLambda = self.lambdavar >= self.lambdaMax
+            self.lambdavar = min(self.lambdavar*self.lambdaFactor, self.lambdaMax)
+        if displacement < self.minDisplacement:
+            self.current['reason'] = 'displacement'
+        elif self._nStalled >= self.stallIterations:
+            self.current['reason'] = 'stalled'
+        elif not accepted and (self._nRejected >= self.maxRejected or atMaxLambda):
+            self.current['reason'] = 'rejected'
+        elif self.current['iterations'] < self.maxIterations:
+            return accepted
+        self.finished = True
+        return accepted
+
+    def iterations(self, stage=None):
+        '''Number of iterations used at each level, as a list of (stage, layer, iterations)'''
+        return [(level['stage'], level['layer'], level['iterations']) for level in self.history
+                if stage is None or level['stage'] == stage]
+
+
+class PixelSampling(object):
+    def __init__(self, nSamples=10000, strategy='random', refine=True, seed=0):
+        '''
+        Strategy to compare images on a subset of pixels at fine pyramid levels.
+
+        With sampling, the cost of each iteration depends on the number of samples instead
+        of the number of pixels. Samples depend only on the target, so they are chosen once
+        per level and shared by all sources (see PreparedTarget).
+
+        Args:
+            nSamples (int): number of pixels used at each level. Levels with fewer pixels
+                use all of them.
+            strategy (str): 'random' for pixels uniformly distributed over the image, or 'gradient'
+                for pixels chosen with probability proportional to the gradient magnitude of the
+                target, among those with above-median gradient (i.e., on textured tissue rather
+                than on flat background).
+            refine (bool): use all pixels at the finest level (minLevel) to refine the result.
+            seed (int): seed of the random number generator (samples are reproducible).
+        '''
+        if strategy not in ('random', 'gradient'):
+            raise ValueError('Unknown sampling strategy: {0}'.format(strategy))
+        self.nSamples = int(nSamples)
+        self.strategy = strategy
+        self.refine = refine
+        self.seed = seed
+
+    def key(self):
+        '''Identifier of the samples (to store them with the data of each level)'''
+        return ('samples', self.nSamples, self.strategy, self.seed)
+
+    def level_samples(self, target, layer, minLevel=0):
+        '''
+        Flat indices of the pixels to use at one level of a PreparedTarget,
+        or None if all pixels should be used.
+        '''
+        if target.pyramid[layer].size <= self.nSamples or (self.refine and layer == minLevel):
+            return None
+        return target.level_data(self.key(), layer, self.select)
+
+    def select(self, image, tgrad):
+        '''Choose the samples for an image given its gradient (gx, gy)'''
+        randomState = np.random.RandomState(self.seed)
+        if self.strategy == 'random':
+            samples = randomState.choice(image.size, self.nSamples, replace=False)
+        else:
+            magnitude = np.hypot(tgrad[0], tgrad[1]).ravel()
+            candidates = np.flatnonzero(magnitude > np.median(magnitude))
+            if len(candidates) <= self.nSamples:
+                samples = candidates
+            else:
+                weights = magnitude[candidates].astype(float)
+                samples = randomState.choice(candidates, self.nSamples, replace=False,
+                                             p=weights/weights.sum())
+        return np.sort(samples)
+
+
+class PreparedTarget(object):
+    def __init__(self, target, pyramidDepth, downscale=2, dtype=None, minLevel=0):
+        '''
+        Target image together with the values that do not depend on the source image.
+
+        The Gaussian pyramid, the gradient of each level and the terms of the Hessian are
+        computed only the first time they are needed, so they can be shared by every source
+        registered to the same target (e.g., all images of a stack in absolute mode).
+
+        Args:
+            target (np.ndarray): target image, the one that will not move.
+            pyramidDepth (int): number of pyramid levels, in addition to the original.
+            downscale (float): downscale factor between pyramid levels.
+            dtype (np.dtype): (optional) np.float32 to store and process the pyramid in single
+                precision. Default: np.float64.
+            minLevel (int): (optional) finest level that will be used (finer levels are not
+                computed, see gaussian_pyramid).
+        '''
+        self.pyramidDepth = pyramidDepth
+        self.downscale = downscale
+        self.minLevel = minLevel
+        self.dtype = np.dtype(np.float64 if dtype is None else dtype)
+        self.pyramid = gaussian_pyramid(target, pyramidDepth, downscale, self.dtype, minLevel)
+        self._levelData = {}
+        self._warpers = {}
+
+    def gradient(self, layer):
+        '''Image gradient (gx, gy) of one level of the pyramid'''
+        return self.level_data('gradient', layer, lambda image, tgrad: image_gradient(image))
+
+    def center_of_mass(self, layer):
+        '''Center of mass (row, col) of one level of the pyramid'''
+        return self.level_data('center', layer,
+                               lambda image, tgrad: scipy.ndimage.measurements.center_of_mass(image))
+
+    def polar_spectrum(self, layer):
+        '''Log-polar magnitude of the spectrum of one level of the pyramid (see polar_spectrum)'''
+        return self.level_data('spectrum', layer, lambda image, tgrad: polar_spectrum(image))
+
+    def warper(self, layer, dtype=None, samples=None):
+        '''
+        SplineWarper for one level of the pyramid, to use this image as a source.
+
+        The warper of each level is kept, so the rigid-body and affine stages of a registration
+        calculate the spline coefficients (needed with samples) once. The warper has its own
+        coordinate buffers, so it should not be used by two threads at the same time.
+        '''
+        dtype = self.dtype if dtype is None else np.dtype(dtype)
+        key = (layer, dtype.str)
+        (lastSamples, warper) = self._warpers.get(key, (None, None))
+        if warper is None or lastSamples is not samples:
+            coefficients = None if warper is None else warper._coefficients
+            warper = SplineWarper(self.pyramid[layer], dtype=dtype, samples=samples,
+                                  coefficients=coefficients)
+            self._warpers[key] = (samples, warper)
+        return warper
+
+    def level_data(self, name, layer, compute):
+        '''
+        Return compute(image, gradient) for one level of the pyramid.
+        The result is calculated only the first time and stored with the given name.
+        '''
+        key = (name, layer)
+        if key not in self._levelData:
+            tgrad = None if name in ('gradient', 'spectrum') else self.gradient(layer)
+            self._levelData[key] = compute(self.pyramid[layer], tgrad)
+        return self._levelData[key]
+
+    def level_terms(self, name, layer, compute, sampling=None, minLevel=0):
+        '''
+        Values needed by a least-squares solver at one level of the pyramid.
+
+        Args:
+            name (str): name used to store the values (e.g., 'rigid').
+            layer (int): level of the pyramid.
+            compute (function): called as compute(image, gradient, samples).
+            sampling (PixelSampling): (optional) strategy to use only some pixels.
+            minLevel (int): finest level that will be used (see PixelSampling).
+
+        Returns:
+            targetTerms: result of compute() for this level.
+            samples (np.ndarray): flat indices of the pixels used (None for all pixels).
+        '''
+        samples = None if sampling is None else sampling.level_samples(self, layer, minLevel)
+        if samples is None:
+            return (self.level_data(name, layer, compute), None)
+        targetTerms = self.level_data((name,)+sampling.key(), layer,
+                                      lambda image, tgrad: compute(image, tgrad, samples))
+        return (targetTerms, samples)
+
+    def prepare(self, minLevel=0, method='rigid', sampling=None, init='com'):
+        '''
+        Calculate in advance all values needed to register images to this target
+        (useful before sending the object to a pool of workers).
+        '''
+        if init == 'fft':
+            self.polar_spectrum(fourier_mellin_layer(self.pyramid, self.pyramidDepth, minLevel))
+        for layer in range(self.pyramidDepth, minLevel-1, -1):
+            self.center_of_mass(layer)
+            self.level_terms('rigid', layer, rigid_body_target_terms, sampling, minLevel)
+        if method == 'affine':
+            from brainmix.modules import affineregistration as affreg
+            for layer in range(self.pyramidDepth, minLevel-1, -1):
+                self.level_terms('affine', layer, affreg.affine_target_terms, sampling, minLevel)
+
+
+class PyramidCache(object):
+    def __init__(self, maxSize=4):
+        '''
+        Recently used images prepared for registration (PreparedTarget objects).
+
+        An image registered to more than one other image (e.g., a slice of a stack that is the
+        source for one neighbor and the target for the other) needs its pyramid only once.
+        Its gradients and Hessian terms are also kept once computed. The cache can be used from
+        several threads.
+
+        Images are identified by the memory they occupy (see array_key) or by a key given by the
+        caller, plus a version that should change whenever the content of the image changes.
+
+        Args:
+            maxSize (int): maximum number of prepared images kept (least recently used are dropped).
+        '''
+        self.maxSize = max(1, maxSize)
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict() # Ordered from least to most recently used
+        self._lock = threading.Lock()
+
+    def get(self, image, pyramidDepth, downscale=2, dtype=None, key=None, version=0, minLevel=0):
+        '''
+        Return the PreparedTarget for an image, creating it if it is not in the cache.
+
+        Args:
+            image (np.ndarray): grayscale image.
+            pyramidDepth, downscale, dtype, minLevel: see PreparedTarget.
+            key: (optional) hashable identifier of the image. Default: array_key(image).
+            version: (optional) version of the image content (e.g., an ID of the stack pass).
+        '''
+        if key is None:
+            key = array_key(image)
+        dtype = np.dtype(np.float64 if dtype is None else dtype)
+        key = (key, version, pyramidDepth, downscale, dtype.str, minLevel)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                self.hits += 1
+                return entry[1]
+        # -- Build the pyramid outside the lock so other threads can use the cache meanwhile --
+        prepared = PreparedTarget(image, pyramidDepth, downscale, dtype, minLevel)
+        with self._lock:
+            self.misses += 1
+            self._entries.pop(key, None)
+            while len(self._entries) >= self.maxSize:
+                self._entries.popitem(last=False)
+            # -- Keep a reference to the image, so its memory (part of the key) is not reused --
+            self._entries[key] = (image, prepared)
+        return prepared
+
+    def clear(self):
+        '''Drop all prepared images'''
+        with self._lock:
+            self._entries.clear()
+
+
+def array_key(image):
+    '''
+    Identify an array by the memory it occupies (views of the same slice of a stack
+    have the same key, even if they are different Python objects).
+    '''
+    image = np.asarray(image)
+    return (image.__array_interface__['data'][0], image.shape, image.strides, image.dtype.str)
+
+
+def working_dtype(image, dtype=None):
+    '''
+    Floating point type used to process an image: the requested one, or float32 if the
+    image is already float32, or float64 otherwise.
+    '''
+    if dtype is not None:
+        return np.dtype(dtype)
+    return np.dtype(np.float32) if image.dtype == np.float32 else np.dtype(np.float64)
+
+
+def gaussian_pyramid(image, pyramidDepth, downscale=2, dtype=None, minLevel=0):
+    '''
+    Gaussian pyramid of an image (as skimage.transform.pyramid_gaussian).
+
+    Levels finer than minLevel are not computed (they are None in the result). Instead,
+    level minLevel is obtained directly from the image by averaging blocks of
+    downscale**minLevel pixels followed by a small Gaussian filter, which approximates the
+    smoothing of the levels in between at a fraction of the cost.
+
+    Args:
+        image (np.ndarray): grayscale image.
+        pyramidDepth (int): number of pyramid levels, in addition to the original.
+        downscale (float): downscale factor between pyramid levels.
+        dtype (np.dtype): (optional) np.float32 to store the levels in single precision.
+            The full-size image is reduced to level minLevel in this type, the coarser levels
+            are computed by skimage in double precision and converted as soon as they are
+            created. Default: np.float64.
+        minLevel (int): finest level that will be used. Only integer downscale factors
+            skip levels; otherwise all levels are computed.
+
+    Returns:
+        pyramid (tuple): images from the original (level 0) to the coarsest level.
+    '''
+    skipped = (None,)*minLevel
+    if minLevel > 0 and downscale == int(downscale):
+        levels = skimage.transform.pyramid_gaussian(decimate(image, int(downscale), minLevel, dtype),
+                                                    max_layer=pyramidDepth-minLevel,
+                                                    downscale=downscale)
+    else:
+        levels = skimage.transform.pyramid_gaussian(image, max_layer=pyramidDepth, downscale=downscale)
+        levels = itertools.islice(levels, minLevel, None)
+    if dtype is None or np.dtype(dtype) == np.float64:
+        return skipped + tuple(levels)
+    return skipped + tuple(level.astype(dtype) for level in levels)
+
+
+def decimate(image, downscale, nLevels, dtype=None):
+    '''
+    Reduce an image as nLevels levels of a Gaussian pyramid would, in a single step.
+
+    Blocks of downscale**nLevels pixels are averaged (padding the borders by repetition
+    if the size is not a multiple), and a Gaussian filter adds the remaining smoothing,
+    so the variance of the blur matches that of skimage.transform.pyramid_reduce applied
+    nLevels times (Gaussian with sigma=2*downscale/6 plus linear interpolation).
+    Intensities are scaled like skimage.img_as_float, but converted directly to dtype
+    (np.float32 avoids a double precision copy of the full-size image).
+
+    Returns:
+        image (np.ndarray): reduced image, of size ceil(shape/downscale**nLevels).
+    '''
+    dtype = np.dtype(np.float64 if dtype is None else dtype)
+    if image.dtype.kind == 'u':
+        maxValue = np.iinfo(image.dtype).max
+        image = image.astype(dtype)
+        image *= 1.0/maxValue
+    elif image.dtype.kind == 'f':
+        image = image.astype(dtype, copy=False)
+    else:
+        image = skimage.img_as_float(image).astype(dtype, copy=False)
+    factor = downscale**nLevels
+    (height, width) = image.shape
+    (outHeight, outWidth) = (-(-height//factor), -(-width//factor))
+    if (outHeight*factor, outWidth*factor) != image.shape:
+        image = np.pad(image, ((0, outHeight*factor-height), (0, outWidth*factor-width)), 'edge')
+    blocks = image.reshape(outHeight, factor, outWidth, factor)
+    reduced = blocks.mean(axis=3).mean(axis=1)
+    # -- Variances in pixels of the original image --
+    levelVariance = (2*downscale/6.0)**2 + 0.25
+    pyramidVariance = sum(levelVariance*downscale**(2*level) for level in range(nLevels))
+    blockVariance = (factor**2-1)/12.0
+    sigma = np.sqrt(max(pyramidVariance-blockVariance, 0))/factor
+    return scipy.ndimage.gaussian_filter(reduced, sigma, mode='reflect')
+
+
+def image_gradient(image):
+    '''
+    Image gradient in horizontal and vertical directions calculated with the Scharr operator.
+
+    The 3x3 Scharr kernels are separable ([3,10,3] smoothing across and [-1,0,1] difference
+    along each direction), so they are applied as 1D filters on real arrays (shifted slices of
+    the padded image). The results are the same as those of
+    convolve2d(image, scharrX+1j*scharrY, boundary='symm', mode='same'), which was used before.
+
+    Args:
+        image (np.ndarray): grayscale image.
+
+    Returns:
+        tgrad (tuple): (gx, gy) horizontal and vertical gradients. They are float32 arrays
+            if the image is float32, float64 otherwise.
+    '''
+    if image.dtype != np.float32:
+        image = np.asarray(image, dtype=float)
+    padded = np.pad(image, 1, mode='symmetric') # Same as boundary='symm' in convolve2d
+    # -- convolve2d flips the kernel, so the difference is (previous - next) --
+    smoothY = 3*(padded[:-2,:] + padded[2:,:]) + 10*padded[1:-1,:]
+    gx = smoothY[:,:-2] - smoothY[:,2:]
+    smoothX = 3*(padded[:,:-2] + padded[:,2:]) + 10*padded[:,1:-1]
+    gy = smoothX[:-2,:] - smoothX[2:,:]
+    return (gx, gy)
+
+
+def rigid_body_target_terms(target, tgrad=None, samples=None):
+    '''
+    Values used by rigid_body_least_squares() that depend only on the target image.
+
+    Args:
+        target (np.ndarray): target image.
+        tgrad (np.ndarray): (optional) gradient of the target, from image_gradient().
+        samples (np.ndarray): (optional) flat indices of the pixels to use (default: all).
+
+    Returns:
+        targetTerms (tuple): (tgrad, dTheta, tHessian). With samples, tgrad and dTheta
+            are 1D arrays with the values at the sampled pixels.
+    '''
+    (height, width) = target.shape
+    if tgrad is None:
+        tgrad = image_gradient(target)
+    (gx, gy) = tgrad
+    if samples is None:
+        xcoords = np.arange(width, dtype=gx.dtype)
+        ycoords = np.arange(height, dtype=gx.dtype)[:,np.newaxis]
+    else:
+        (gx, gy) = tgrad = (gx.ravel()[samples], gy.ravel()[samples])
+        xcoords = (samples % width).astype(gx.dtype)
+        ycoords = (samples // width).astype(gx.dtype)
+    dTheta = gy*xcoords - gx*ycoords
+    # -- The Hessian is accumulated in double precision, even for float32 gradients --
+    tHessian = np.array([[np.sum(dTheta**2, dtype=np.float64), np.sum(dTheta*gx, dtype=np.float64),
+                          np.sum(dTheta*gy, dtype=np.float64)],
+                         [0, np.sum(gx**2, dtype=np.float64), np.sum(gx*gy, dtype=np.float64)],
+                         [0, 0, np.sum(gy**2, dtype=np.float64)] ])
+    tHessian += np.triu(tHessian,1).T
+    return (tgrad, dTheta, tHessian)
+
+
+def polar_spectrum(image, nAngles=180):
+    '''
+    Magnitude of the Fourier transform of an image, resampled on a log-polar grid.
+
+    The magnitude does not change when the image is translated, and a rotation of the
+    image shifts it circularly along the angle axis (the first axis, covering [0, pi)).
+    The image is windowed and padded to a square so the frequency axes have the same scale.
+
+    Args:
+        image (np.ndarray): grayscale image.
+        nAngles (int): number of angles sampled between 0 and pi.
+
+    Returns:
+        spectrum (np.ndarray): [nAngles, nRadii] log-magnitude of the spectrum.
+    '''
+    size = max(image.shape)
+    windowed = np.zeros((size, size))
+    windowed[:image.shape[0], :image.shape[1]] = (image-np.mean(image))*_hann_window(image.shape)
+    magnitude = np.log1p(np.abs(np.fft.fftshift(np.fft.fft2(windowed))))
+    # -- Skip the lowest frequencies, which are mostly affected by the window --
+    radii = np.exp(np.linspace(np.log(2), np.log(size//2-1), size//2))
+    angles = np.linspace(0, np.pi, nAngles, endpoint=False)
+    rows = size//2 - np.outer(np.sin(angles), radii)
+    cols = size//2 + np.outer(np.cos(angles), radii)
+    return scipy.ndimage.map_coordinates(magnitude, [rows, cols], order=1)
+
+
+def phase_correlation(image, reference):
+    '''
+    Find the circular shift between two images of the same shape by phase correlation.
+
+    Args:
+        image (np.ndarray): shifted image, so that image[p] ~ reference[p-shift].
+        reference (np.ndarray): reference image.
+
+    Returns:
+        shift (np.ndarray): (2,) shift (row, col) with subpixel precision.
+        peak (float): height of the correlation peak (closer to 1 for a better match).
+    '''
+    crossPower = np.fft.fft2(image)*np.conj(np.fft.fft2(reference))
+    crossPower /= np.maximum(np.abs(crossPower), 1e-12)
+    return _correlation_peak(np.real(np.fft.ifft2(crossPower)))
+
+
+def fourier_mellin_initialization(source, target, targetSpectrum=None, sourceSpectrum=None):
+    '''
+    Estimate the rigid-body transformation between two images with FFTs.
+
+    The rotation is found by correlating the log-polar spectra of the images along the
+    angle axis (Fourier-Mellin), and the translation by phase correlation of the rotated
+    source and the target. This recovers large rotations and translations at a cost of
+    O(N log N), before the Levenberg-Marquardt refinement.
+
+    Args:
+        source (np.ndarray): source image, the one that will be transformed.
+        target (np.ndarray): target image, the one that will not move (same shape as source).
+        targetSpectrum (np.ndarray): (optional) precalculated polar_spectrum(target).
+        sourceSpectrum (np.ndarray): (optional) precalculated polar_spectrum(source).
+
+    Returns:
+        tfrm (np.ndarray): (3,) transformation [rotation_angle, translation_x, translation_y].
+    '''
+    if targetSpectrum is None:
+        targetSpectrum = polar_spectrum(target)
+    if sourceSpectrum is None:
+        sourceSpectrum = polar_spectrum(source, len(targetSpectrum))
+    # -- Cross-correlation along the angle axis, summed over all radii --
+    crossPower = np.fft.fft(sourceSpectrum-sourceSpectrum.mean(axis=0), axis=0) * \
+                 np.conj(np.fft.fft(targetSpectrum-targetSpectrum.mean(axis=0), axis=0))
+    (angleShift, peak) = _correlation_peak(np.real(np.fft.ifft(crossPower.sum(axis=1))))
+    angle = -angleShift[0]*np.pi/len(targetSpectrum)
+    # -- Rotate around the center of the image, and test angle+pi too (the spectrum is symmetric) --
+    window = _hann_window(target.shape)
+    (centerY, centerX) = (np.array(target.shape)-1)/2.0
+    toCenter = np.array([[1, 0, centerX], [0, 1, centerY], [0, 0, 1.0]])
+    fromCenter = np.array([[1, 0, -centerX], [0, 1, -centerY], [0, 0, 1.0]])
+    bestPeak = -np.inf
+    for theta in (angle, angle+np.pi):
+        rotation = np.dot(toCenter, np.dot(rigid_body_matrix([theta, 0, 0]), fromCenter))
+        rotated = skimage.transform.warp(source, rotation, order=1, mode='nearest')
+        (shift, peak) = phase_correlation((rotated-np.mean(rotated))*window,
+                                          (target-np.mean(target))*window)
+        if peak > bestPeak:
+            bestPeak = peak
+            translation = np.array([[1, 0, shift[1]], [0, 1, shift[0]], [0, 0, 1.0]])
+            tfrm = rigid_body_parameters(np.dot(rotation, translation))
+    return tfrm
+
+
+def fourier_mellin_layer(pyramid, pyramidDepth, minLevel=0):
+    '''
+    Coarsest level of a pyramid (between minLevel and pyramidDepth) that is still large
+    enough (FOURIER_MELLIN_SIZE pixels per side) to estimate rotations from its spectrum.
+    '''
+    layer = minLevel
+    while layer < pyramidDepth and min(pyramid[layer+1].shape) >= FOURIER_MELLIN_SIZE:
+        layer += 1
+    return layer
+
+
+def _correlation_peak(correlation):
+    '''
+    Position of the maximum of a circular correlation (refined with a parabola through its
+    neighbors), as a signed shift along each axis, and the value of the maximum.
+    '''
+    peakInd = np.unravel_index(np.argmax(correlation), correlation.shape)
+    shift = np.array(peakInd, dtype=float)
+    for axis, size in enumerate(correlation.shape):
+        before = list(peakInd)
+        after = list(peakInd)
+        before[axis] = (peakInd[axis]-1) % size
+        after[axis] = (peakInd[axis]+1) % size
+        (left, center, right) = (correlation[tuple(before)], correlation[peakInd],
+                                 correlation[tuple(after)])
+        curvature = left - 2*center + right
+        if curvature < 0:
+            shift[axis] += 0.5*(left-right)/curvature
+        if shift[axis] > size/2.0:
+            shift[axis] -= size
+    return (shift, correlation[peakInd])
+
+
+def _hann_window(shape):
+    '''Two-dimensional Hann window, to reduce the effect of image borders on FFTs'''
+    return np.outer(np.hanning(shape[0]), np.hanning(shape[1]))
+
+
+def rigid_body_least_squares(source, target, tfrm, maxIterations, targetTerms=None, warper=None,
+                             samples=None, convergence=None, layer=None):
     '''
     Apply modified Levenberg-Marquardt algorithm to minimize the difference in pixel
     intensities between the source and target images.
@@ -48,6 +774,13 @@ def rigid_body_least_squares(source, target, tfrm, maxIterations):
         source (np.ndarray): source image, the one that will be transformed.
         target (np.ndarray): target image, the one that will not move.
         tfrm (np.ndarray): (3,) initial transformation [rotation_angle, translation_x, translation_y].
+        maxIterations (int): maximum number of iterations.
+        targetTerms (tuple): (optional) precalculated rigid_body_target_terms(target).
+        warper (SplineWarper): (optional) warper for the source image.
+        samples (np.ndarray): (optional) flat indices of the pixels to compare (default: all).
+            The same samples must be used for targetTerms and warper.
+        convergence (ConvergenceController): (optional) rules to stop iterating.
+        layer (int): (optional) pyramid level of the images (only recorded by convergence).
 
     Returns:
         tfrm (np.ndarray): (3,) best transformation [rotation_angle, translation_x, translation_y].
@@ -55,45 +788,40 @@ def rigid_body_least_squares(source, target, tfrm, maxIterations):
     imshape = source.shape
     (height, width) = imshape
     newtfrm = tfrm.copy()
-    lambdavar = 1.0
-    # -- Use Scharr operator to calculate image gradient in horizontal and vertical directions --
-    scharr = np.array([[-3-3j, 0-10j, +3-3j], [-10+0j, 0+0j, +10+0j], [-3+3j, 0+10j, +3+3j]])
-    tgrad = scipy.signal.convolve2d(target, scharr, boundary='symm', mode='same')
+    if convergence is None:
+        convergence = ConvergenceController()
+    # -- Image gradient (Scharr operator) and Hessian depend only on the target --
+    if targetTerms is None:
+        targetTerms = rigid_body_target_terms(target, samples=samples)
+    ((gx, gy), dTheta, tHessian) = targetTerms
+    # -- The warper keeps what all iterations need (e.g., spline coefficients with samples) --
+    if warper is None:
+        warper = SplineWarper(source, dtype=target.dtype, samples=samples)
+    warped = np.empty(warper.outputShape, dtype=warper.dtype)
+    if samples is not None:
+        target = target.ravel()[samples]
     # -- Calculate current error --
-    err = target - rigid_body_transform(source, tfrm)
-    bestMeanSquares = np.mean(err**2)
-    # -- Pre-calculate the Hessian --
-    dTheta = tgrad.imag*np.arange(width) - tgrad.real*np.arange(height)[:,np.newaxis]
+    err = target - warper.warp(rigid_body_matrix(tfrm), warped)
+    convergence.start(np.mean(err**2), maxIterations, 'rigid', layer)
     (heightSq,widthSq) = np.array(imshape)**2
-    displacement = 1.0
-    tHessian = np.array([[np.sum(dTheta**2), np.sum(dTheta*tgrad.real), np.sum(dTheta*tgrad.imag)],
-                        [0, np.sum(tgrad.real**2), np.sum(tgrad.real*tgrad.imag)],
-                        [0, 0, np.sum(tgrad.imag**2)] ])
-    tHessian += np.triu(tHessian,1).T
-    # NOTE: using range() for compatibility with Python3
-    for iteration in range(int(maxIterations)):
-        gradient = np.array([np.sum(err*dTheta), 
-                             np.sum(err*tgrad.real), 
-                             np.sum(err*tgrad.imag)])
-        tHessianDiag = np.diag(lambdavar*np.diag(tHessian))
-        update = np.dot(np.linalg.inv(tHessian+tHessianDiag),gradient)
+    # -- The gradient is evaluated at the best transformation so far (rejected steps keep it) --
+    gradient = np.array([np.sum(err*dTheta), np.sum(err*gx), np.sum(err*gy)])
+    while not convergence.finished:
+        tHessianDiag = np.diag(convergence.lambdavar*np.diag(tHessian))
+        update = np.linalg.solve(tHessian+tHessianDiag, gradient)
         attempt = newtfrm - update
         displacement = np.sqrt(update[1]*update[1] + update[2]*update[2]) + \
                        0.25 * np.sqrt(widthSq + heightSq) * np.absolute(update[0])
-        err = target - rigid_body_transform(source, attempt)
-        if np.mean(err**2)<bestMeanSquares:
-            bestMeanSquares = np.mean(err**2)
+        err = target - warper.warp(rigid_body_matrix(attempt), warped)
+        if convergence.update(np.mean(err**2), displacement):
             # NOTE: Numpy 1.7 or newer has np.copyto() which should be faster than copy()
             newtfrm = attempt.copy() # We need to copy values, tfrm=attempt would just make a reference to 'attempt'
-            lambdavar /= 10.0 # FIXME: we may need to prevent lambda from becoming 0
-        else:
-            lambdavar *= 10.0
-        if displacement < 0.001:
-            break
+            gradient = np.array([np.sum(err*dTheta), np.sum(err*gx), np.sum(err*gy)])
     return newtfrm
             
 
-def rigid_body_registration(source, target, pyramidDepth, minLevel=0, downscale=2, debug=False):
+def rigid_body_registration(source, target, pyramidDepth, minLevel=0, downscale=2, debug=False,
+                            dtype=None, sampling=None, convergence=None, init='com'):
     '''
     Find transformation that registers source image to the target image.
 
@@ -102,26 +830,69 @@ def rigid_body_registration(source, target, pyramidDepth, minLevel=0, downscale=
 
     Args:
         source (np.ndarray): source image, the one that will be transformed.
+            A PreparedTarget can be given instead to reuse its pyramid.
         target (np.ndarray): target image, the one that will not move.
+            A PreparedTarget can be given instead to reuse its pyramid, gradients and Hessians.
         pyramidDepth (int): number of pyramid levels, in addition to the original.
         minLevel (int): 0 for original level, >0 for coarser resolution.
+        dtype (np.dtype): (optional) np.float32 to register in single precision (pyramids,
+            gradients, warps and errors), which halves memory traffic. Default: np.float64,
+            or the type of the PreparedTarget.
+        sampling (PixelSampling): (optional) compare images only on a subset of pixels at
+            fine levels.
+        convergence (ConvergenceController): (optional) iterations per level and stopping rules.
+            Its history records the iterations used at each level.
+        init (str): (optional) initial guess. 'com' aligns the centers of mass (no rotation).
+            'fft' estimates rotation and translation by Fourier-Mellin phase correlation
+            (see fourier_mellin_initialization), which handles large rotations.
     
     Return:
         tfrm (np.ndarray): (3,) best transformation [rotation_angle, translation_x, translation_y].
     '''
-    sourcePyramid = tuple(skimage.transform.pyramid_gaussian(source, max_layer=pyramidDepth, downscale=downscale))
-    targetPyramid = tuple(skimage.transform.pyramid_gaussian(target, max_layer=pyramidDepth, downscale=downscale))
-    # -- compute the center of mass for each image to provide the initial guess for the translation --
-    scenter = scipy.ndimage.measurements.center_of_mass(sourcePyramid[minLevel])
-    tcenter = scipy.ndimage.measurements.center_of_mass(targetPyramid[minLevel])
-    tfrm = np.array([0, scenter[0]-tcenter[0], scenter[1]-tcenter[1]])
-    tfrm[1:] /= pow(downscale,pyramidDepth-minLevel)
+    if dtype is None and isinstance(target, PreparedTarget):
+        dtype = target.dtype
+    if isinstance(source, PreparedTarget):
+        sourcePyramid = source.pyramid
+    else:
+        sourcePyramid = gaussian_pyramid(source, pyramidDepth, downscale, dtype, minLevel)
+    if not isinstance(target, PreparedTarget):
+        target = PreparedTarget(target, pyramidDepth, downscale, dtype, minLevel)
+    targetPyramid = target.pyramid
+    if sourcePyramid[minLevel] is None or targetPyramid[minLevel] is None:
+        raise ValueError('The pyramids do not include level {0}.'.format(minLevel))
+    if init == 'com':
+        # -- compute the center of mass for each image to provide the initial guess for the translation --
+        scenter = scipy.ndimage.measurements.center_of_mass(sourcePyramid[minLevel])
+        tcenter = target.center_of_mass(minLevel)
+        tfrm = np.array([0, scenter[0]-tcenter[0], scenter[1]-tcenter[1]])
+        tfrm[1:] /= pow(downscale,pyramidDepth-minLevel)
+        startLayer = pyramidDepth
+    elif init == 'fft':
+        # -- estimate rotation and translation on a coarse level and refine from there, since --
+        # -- coarser levels are too small to improve the estimate (translation is scaled back --
+        # -- because it is multiplied by downscale at the beginning of each level) --
+        startLayer = fourier_mellin_layer(targetPyramid, pyramidDepth, minLevel)
+        sourceSpectrum = source.polar_spectrum(startLayer) if isinstance(source, PreparedTarget) else None
+        tfrm = fourier_mellin_initialization(sourcePyramid[startLayer], targetPyramid[startLayer],
+                                             target.polar_spectrum(startLayer), sourceSpectrum)
+        tfrm[1:] /= downscale
+    else:
+        raise ValueError('Unknown initialization: {0}'.format(init))
     #tfrm = np.zeros(3)
+    if convergence is None:
+        convergence = ConvergenceController()
 
-    for layer in range(pyramidDepth, minLevel-1, -1):
+    for layer in range(startLayer, minLevel-1, -1):
         tfrm[1:] *= downscale  # Scale translation for next level in pyramid
+        (targetTerms, samples) = target.level_terms('rigid', layer, rigid_body_target_terms,
+                                                    sampling, minLevel)
+        if isinstance(source, PreparedTarget):
+            warper = source.warper(layer, target.dtype, samples)
+        else:
+            warper = SplineWarper(sourcePyramid[layer], dtype=target.dtype, samples=samples)
         tfrm = rigid_body_least_squares(sourcePyramid[layer],targetPyramid[layer],
-                                        tfrm, int(10*2**(layer-1)))
+                                        tfrm, convergence.max_iterations(layer), targetTerms,
+                                        warper, samples, convergence, layer)
         toptfrm = np.concatenate(([tfrm[0]],tfrm[1:]*pow(downscale,layer)));
         if debug:
             print 'Layer {0}: {1}x{2}'.format(layer, *targetPyramid[layer].shape)
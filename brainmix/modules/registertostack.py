@@ -5,6 +5,7 @@ for other cases of registering one stack of images to another.
 
 import numpy as np
 from brainmix.modules import imregistration as imreg
+from brainmix.modules import transforms
 import scipy.misc
 
 def downscale_stack_register(regstack, sourcestack, downscale, corner=(0,0)):
@@ -41,8 +42,9 @@ def downscale_stack_register(regstack, sourcestack, downscale, corner=(0,0)):
     pyramidDepth = imreg.get_pyramid_depth(downstack[image])
     for image in range(len(downstack)):
         tfrm = imreg.rigid_body_registration(downstack[image], regstackquarter[image], pyramidDepth, 2)
-        tfrm[1:] /= downscale
-        img = imreg.rigid_body_transform(sourcestack[image], tfrm)
+        # -- Express the transformation at full resolution and resample the original image once --
+        tfrm = transforms.rescale(tfrm, downscale)
+        img = transforms.warp_image(sourcestack[image], tfrm)
         regdownstack.append(img)
     return regdownstack
         
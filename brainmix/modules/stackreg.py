@@ -1,69 +1,431 @@
-import imregistration as imreg
+from brainmix.modules import imregistration as imreg
+from brainmix.modules import affineregistration as affreg
+from brainmix.modules import transforms
+import itertools
+import threading
+import multiprocessing
+import multiprocessing.pool
 import numpy as np
 import matplotlib.pyplot as plt
 import skimage.io
 from scipy import interpolate
 
-def register_stack(stack, targetInd=0, relative=True):
+def register_stack(stack, targetInd=0, relative=True, outstack=None, parallel=False, nworkers=None,
+                   usethreads=False, progress=None, method='rigid', returntransforms=False, dtype=None,
+                   sampling=None, convergence=None, init='com', diagnostics=None):
     '''
     Register a stack of images to each other. A target image is specified that all others will be 
     registered to (the first image if none is specified). The target's neighbors will be registered to
     the target, and then every subsequent image will be registered to its neighbor, resulting in a stack
     of registered images in the same orientation as the target.
 
+    In relative mode, each image is registered to its original (not yet aligned) neighbor, and the
+    chain of transformations from each image to the target is composed into a single one. This way
+    every original image is resampled only once, so interpolation blur does not accumulate along the
+    stack. These registrations are independent, so they can run on a pool of workers (processes or
+    threads). Threads avoid copying images to other processes, but they only run in parallel while
+    NumPy/SciPy functions release the GIL.
+
     Args: 
         stack (np.ndarray): [nImages, height, width] stack of images for registration.
         targetInd (int): (optional) index of image to be used as first target. Default=0.
+        relative (bool): (optional) register each image to its neighbor (True) or to the target.
+        outstack (np.ndarray): (optional) [nImages, height, width] preallocated array for the
+            results (e.g., a memory-mapped stack). A new array is created if None.
+        parallel (bool): (optional) register and warp images on a pool of workers.
+        nworkers (int): (optional) number of workers for parallel mode. Default: number of CPUs.
+        usethreads (bool): (optional) use a pool of threads instead of processes.
+        progress (function): (optional) called as progress(nDone, nTotal) after each task.
+            There are two tasks per image (registration and warping).
+        method (str): (optional) 'rigid' or 'affine'.
+        returntransforms (bool): (optional) return also the transformation of each image.
+        dtype (np.dtype): (optional) np.float32 to find transformations in single precision
+            (faster, less memory). Default: np.float64.
+        sampling (imreg.PixelSampling): (optional) compare images only on a subset of pixels
+            at fine pyramid levels.
+        convergence (imreg.ConvergenceController): (optional) iterations per pyramid level and
+            stopping rules. Each image is registered with a copy of it.
+        init (str): (optional) initial guess of each registration: 'com' (centers of mass) or
+            'fft' (Fourier-Mellin phase correlation, for large rotations).
+        diagnostics (dict): (optional) filled with the convergence history of each registered
+            image (the history of its imreg.ConvergenceController), indexed by image.
 
     Returns:
         outstack (np.ndarray): [nImages, height, width] stack of registered images.
+        tfrms (np.ndarray): (only if returntransforms) see estimate_stack_transforms().
     '''
     nImages = len(stack)
-    outstack = stack.copy() #np.empty(stack.shape)
-    pyramidDepth = imreg.get_pyramid_depth(stack[targetInd])
-    minLevel = 3 # FIXME: HARDCODED for JaraLab
-    print 'Registering stack...'
-    for imageInd in range(targetInd-1,-1,-1):
-        if relative:
-            newTargetInd = imageInd+1
-        else:
-            newTargetInd = targetInd
-        print '{0} to {1}'.format(imageInd,newTargetInd)
-        tfrm = imreg.rigid_body_registration(stack[imageInd], outstack[newTargetInd],
-                                             pyramidDepth, minLevel)
-        outimg = imreg.rigid_body_transform(stack[imageInd], tfrm)
-        outstack[imageInd] = outimg
-    for imageInd in range(targetInd+1,nImages):
-        if relative:
-            newTargetInd = imageInd-1
-        else:
-            newTargetInd = targetInd
-        print '{0} to {1}'.format(imageInd,newTargetInd)
-        tfrm = imreg.rigid_body_registration(stack[imageInd], outstack[newTargetInd],
-                                             pyramidDepth, minLevel)
-        outimg = imreg.rigid_body_transform(stack[imageInd], tfrm)
-        outstack[imageInd] = outimg
-    '''
-    if targetInd != len(stack):
-        for imageInd in range(targetInd+1, len(stack)):
-            print imageInd
-            tfrm = imreg.rigid_body_registration(stack[imageInd], outimg, pyramidDepth, minLevel)
-            outimg = rigid_body_transform(stack[imageInd], tfrm)
-            outstack[imageInd] = outimg
-    outimg = stack[targetInd]
-    if targetInd != 0:
-        for imageInd in reversed(range(targetInd)):
-            print imageInd
-            tfrm = imreg.rigid_body_registration(stack[imageInd], outimg, pyramidDepth, minLevel)
-            outimg = rigid_body_transform(stack[imageInd], tfrm)
-            outstack[imageInd] = outimg
-        #outstack = outstack[::-1]
-        #outstack.extend(outstack2)
-    '''
+    if outstack is None:
+        outstack = stack.copy() #np.empty(stack.shape)
+    else:
+        outstack[targetInd] = stack[targetInd]
+    imageInds = [ind for ind in range(nImages) if ind != targetInd]
+    nTotal = 2*len(imageInds)
+    if progress is not None:
+        estimateProgress = lambda nDone, nTasks: progress(nDone, nTotal)
+        warpProgress = lambda nDone, nTasks: progress(len(imageInds)+nDone, nTotal)
+    else:
+        estimateProgress = warpProgress = None
+    engineOptions = {'dtype': dtype, 'sampling': sampling, 'convergence': convergence,
+                     'init': init}
+    sharedTarget = None if relative else _prepare_target(stack, targetInd, method, engineOptions)
+    if parallel:
+        if nworkers is None:
+            nworkers = multiprocessing.cpu_count()
+        pool = _make_pool(nworkers, usethreads, sharedTarget)
+        print 'Registering stack ({0} {1})...'.format(nworkers, 'threads' if usethreads else 'processes')
+    else:
+        pool = None
+        print 'Registering stack...'
+    succeeded = False
+    try:
+        tfrms = _estimate(stack, targetInd, relative, method, pool, estimateProgress, sharedTarget,
+                          engineOptions, nworkers, diagnostics)
+        _warp(stack, tfrms, imageInds, outstack, pool, warpProgress, nworkers)
+        succeeded = True
+    finally:
+        _close_pool(pool, terminate=not succeeded)
     print 'Done registering stack.'
+    if returntransforms:
+        return (outstack, tfrms)
+    return outstack
+
+
+def register_stack_parallel(stack, targetInd=0, relative=True, outstack=None, nworkers=None,
+                            usethreads=False, progress=None, method='rigid', returntransforms=False,
+                            dtype=None, sampling=None, convergence=None, init='com',
+                            diagnostics=None):
+    '''
+    Register a stack of images using a pool of workers (processes or threads).
+    Same as register_stack(..., parallel=True), see its documentation.
+    '''
+    return register_stack(stack, targetInd, relative, outstack, True, nworkers, usethreads,
+                          progress, method, returntransforms, dtype, sampling, convergence, init,
+                          diagnostics)
+
+
+def estimate_stack_transforms(stack, targetInd=0, relative=True, parallel=False, nworkers=None,
+                              usethreads=False, progress=None, method='rigid', dtype=None,
+                              sampling=None, convergence=None, init='com', diagnostics=None):
+    '''
+    Find the transformation that registers each image of a stack to the target,
+    without creating a stack of registered images.
+
+    The transformations can be applied later with apply_stack_transforms() to this
+    stack or to other stacks of the same size (e.g., other channels).
+
+    Args:
+        stack (np.ndarray): [nImages, height, width] stack of images for registration.
+        targetInd (int): (optional) index of image to be used as reference. Default=0.
+        relative (bool): (optional) register each image to its neighbor (True) or to the target.
+        parallel (bool): (optional) register images on a pool of workers.
+        nworkers (int): (optional) number of workers for parallel mode. Default: number of CPUs.
+        usethreads (bool): (optional) use a pool of threads instead of processes.
+        progress (function): (optional) called as progress(nDone, nTotal) after each image.
+        method (str): (optional) 'rigid' or 'affine'.
+        dtype (np.dtype): (optional) np.float32 to register in single precision. Default: np.float64.
+        sampling (imreg.PixelSampling): (optional) compare images only on a subset of pixels.
+        convergence (imreg.ConvergenceController): (optional) iterations per pyramid level and
+            stopping rules. Each image is registered with a copy of it.
+        init (str): (optional) 'com' or 'fft' initial guess (see register_stack).
+        diagnostics (dict): (optional) filled with the convergence history of each image.
+
+    Returns:
+        tfrms (np.ndarray): [nImages, 3] rigid-body transformations [theta, tx, ty], or
+            [nImages, 3, 3] affine transformation matrices. The target has the identity.
+    '''
+    engineOptions = {'dtype': dtype, 'sampling': sampling, 'convergence': convergence,
+                     'init': init}
+    sharedTarget = None if relative else _prepare_target(stack, targetInd, method, engineOptions)
+    if parallel and nworkers is None:
+        nworkers = multiprocessing.cpu_count()
+    pool = _make_pool(nworkers, usethreads, sharedTarget) if parallel else None
+    succeeded = False
+    try:
+        tfrms = _estimate(stack, targetInd, relative, method, pool, progress, sharedTarget,
+                          engineOptions, nworkers, diagnostics)
+        succeeded = True
+    finally:
+        _close_pool(pool, terminate=not succeeded)
+    return tfrms
+
+
+def apply_stack_transforms(stack, tfrms, outstack=None, parallel=False, nworkers=None,
+                           usethreads=False, progress=None):
+    '''
+    Warp each image of a stack according to the transformations from estimate_stack_transforms().
+
+    Args:
+        stack (np.ndarray): [nImages, height, width] stack of images.
+        tfrms (np.ndarray): [nImages, 3] rigid-body or [nImages, 3, 3] affine transformations.
+        outstack (np.ndarray): (optional) [nImages, height, width] preallocated array for the results.
+        parallel (bool): (optional) warp images on a pool of workers.
+        nworkers (int): (optional) number of workers for parallel mode. Default: number of CPUs.
+        usethreads (bool): (optional) use a pool of threads instead of processes.
+        progress (function): (optional) called as progress(nDone, nTotal) after each image.
+
+    Returns:
+        outstack (np.ndarray): [nImages, height, width] stack of registered images.
+    '''
+    if len(tfrms) != len(stack):
+        raise ValueError('There should be one transformation per image.')
+    if outstack is None:
+        outstack = stack.copy()
+    if parallel and nworkers is None:
+        nworkers = multiprocessing.cpu_count()
+    pool = _make_pool(nworkers, usethreads) if parallel else None
+    succeeded = False
+    try:
+        _warp(stack, tfrms, range(len(stack)), outstack, pool, progress, nworkers)
+        succeeded = True
+    finally:
+        _close_pool(pool, terminate=not succeeded)
     return outstack
 
 
+def warp_image(image, tfrm):
+    '''Apply a rigid-body [theta,tx,ty] or (3,3) affine transformation to an image'''
+    return transforms.warp_image(image, tfrm)
+
+
+def register_image(source, target, pyramidDepth, minLevel, method='rigid', history=None,
+                   **engineOptions):
+    '''
+    Find the rigid-body or affine transformation that registers source to target.
+    Other options (e.g., dtype, sampling, init) are passed to the registration function.
+    A ConvergenceController given as convergence is copied, so calls can run concurrently.
+    If a list is given as history, the convergence records of this registration (see
+    imreg.ConvergenceController) are appended to it.
+    '''
+    convergence = engineOptions.get('convergence')
+    if convergence is not None:
+        convergence = convergence.copy()
+    elif history is not None:
+        convergence = imreg.ConvergenceController()
+    engineOptions = dict(engineOptions, convergence=convergence)
+    if method == 'rigid':
+        tfrm = imreg.rigid_body_registration(source, target, pyramidDepth, minLevel, **engineOptions)
+    elif method == 'affine':
+        tfrm = affreg.affine_registration(source, target, pyramidDepth, minLevel, **engineOptions)
+    else:
+        raise ValueError('Unknown registration method: {0}'.format(method))
+    if history is not None:
+        history.extend(convergence.history)
+    return tfrm
+
+
+def _pyramid_levels(image):
+    '''Return (pyramidDepth, minLevel) used to register images like this one'''
+    pyramidDepth = imreg.get_pyramid_depth(image)
+    minLevel = 3 # FIXME: HARDCODED for JaraLab
+    return (pyramidDepth, minLevel)
+
+
+def _prepare_target(stack, targetInd, method, engineOptions):
+    '''Calculate everything that depends only on the target, to share it among all images'''
+    (pyramidDepth, minLevel) = _pyramid_levels(stack[targetInd])
+    sharedTarget = imreg.PreparedTarget(stack[targetInd], pyramidDepth, dtype=engineOptions['dtype'],
+                                        minLevel=minLevel)
+    sharedTarget.prepare(minLevel, method, engineOptions['sampling'], engineOptions['init'])
+    return sharedTarget
+
+
+def _estimate(stack, targetInd, relative, method, pool=None, progress=None, sharedTarget=None,
+              engineOptions=None, nworkers=None, diagnostics=None):
+    '''
+    Register each image to its original neighbor or to the target (see register_stack).
+    In absolute mode, sharedTarget is the imreg.PreparedTarget for the target image.
+    If diagnostics is a dict, the convergence history of each image is stored in it.
+    Images are read from the stack only when a worker is ready for them, so stacks stored
+    on disk are never loaded as a whole.
+    '''
+    if engineOptions is None:
+        engineOptions = {}
+    nImages = len(stack)
+    tfrms = transforms.identity(nImages, method)
+    (pyramidDepth, minLevel) = _pyramid_levels(stack[targetInd])
+    imageInds = [ind for ind in range(nImages) if ind != targetInd]
+    keepHistory = diagnostics is not None
+    processes = pool is not None and not isinstance(pool, multiprocessing.pool.ThreadPool)
+    if relative:
+        # -- Each image is the source of one pair and the target of its neighbor's pair, so --
+        # -- runs of neighboring pairs are sent to one worker, which builds each pyramid once --
+        runs = _neighbor_runs(nImages, targetInd, _run_length(len(imageInds), pool, nworkers))
+        def tasks():
+            for run in runs:
+                if processes:
+                    images = dict((ind, stack[ind]) for ind in sorted(set(itertools.chain(*run))))
+                else:
+                    images = stack # Threads read each image only when they need it
+                yield (run, images, pyramidDepth, minLevel, method, engineOptions, keepHistory)
+        registerTask = _register_run
+        # -- Each task sent to a process holds several images, so fewer tasks are read ahead --
+        maxPending = nworkers+1 if processes and nworkers is not None else None
+    else:
+        if processes:
+            # -- Worker processes received the prepared target when they started (see _make_pool) --
+            sharedTarget = None
+        def tasks():
+            for ind in imageInds:
+                yield (ind, stack[ind], sharedTarget, pyramidDepth, minLevel, method,
+                       engineOptions, keepHistory)
+        registerTask = _register_pair
+        maxPending = None
+    nDone = 0
+    for results in _map(pool, registerTask, tasks(), nworkers, maxPending):
+        for ind, tfrm, history in results:
+            tfrms[ind] = tfrm
+            if diagnostics is not None:
+                diagnostics[ind] = history
+            nDone += 1
+            if progress is not None:
+                progress(nDone, len(imageInds))
+    if relative:
+        tfrms = transforms.chain_to_target(tfrms, targetInd, method)
+    return tfrms
+
+
+def _warp(stack, tfrms, imageInds, outstack, pool=None, progress=None, nworkers=None):
+    '''Warp the images given by imageInds and store them in outstack'''
+    tasks = ((ind, stack[ind], tfrms[ind]) for ind in imageInds)
+    nDone = 0
+    for ind, outimg in _map(pool, _warp_image, tasks, nworkers):
+        outstack[ind] = outimg
+        nDone += 1
+        if progress is not None:
+            progress(nDone, len(imageInds))
+
+
+def _neighbor_runs(nImages, targetInd, runLength):
+    '''
+    Split the pairs (sourceInd, targetInd) of relative registration into runs of neighbors.
+    Pairs go away from the target, so the source of each pair is the target of the next one.
+    '''
+    below = [(ind, ind+1) for ind in range(targetInd-1, -1, -1)]
+    above = [(ind, ind-1) for ind in range(targetInd+1, nImages)]
+    runs = []
+    for pairs in (below, above):
+        runs += [pairs[start:start+runLength] for start in range(0, len(pairs), runLength)]
+    return runs
+
+
+_maxRunLength = 4 # Most neighboring pairs registered by one worker task (see _neighbor_runs)
+
+def _run_length(nPairs, pool=None, nworkers=None):
+    '''Pairs per task: longer runs share more pyramids, shorter runs keep all workers busy'''
+    if pool is None:
+        return max(1, nPairs) # Without workers, each side of the target is a single run
+    if nworkers is None:
+        nworkers = multiprocessing.cpu_count()
+    return max(1, min(_maxRunLength, nPairs//(2*nworkers)))
+
+
+def _map(pool, func, tasks, nworkers=None, maxPending=None):
+    '''
+    Apply func to each task, on the pool of workers if there is one (results in any order).
+    Tasks may come from a generator. The pool reads ahead at most maxPending tasks (default:
+    two per worker), so the images of pending tasks are not all kept in memory.
+    '''
+    if pool is None:
+        return (func(task) for task in tasks)
+    if nworkers is None:
+        nworkers = multiprocessing.cpu_count()
+    if maxPending is None:
+        maxPending = 2*nworkers
+    slots = threading.Semaphore(maxPending)
+    def throttled():
+        for task in tasks:
+            slots.acquire()
+            yield task
+    return _release_each(pool.imap_unordered(func, throttled()), slots)
+
+
+def _release_each(results, slots):
+    '''Yield each result, giving its slot back to the generator of tasks (see _map)'''
+    for result in results:
+        slots.release()
+        yield result
+
+
+def _make_pool(nworkers=None, usethreads=False, sharedTarget=None):
+    '''
+    Create a pool of processes or threads (with nworkers=None, one per CPU).
+    The shared target is sent once to each worker process, instead of once per task.
+    '''
+    if nworkers is None:
+        nworkers = multiprocessing.cpu_count()
+    if usethreads:
+        pool = multiprocessing.pool.ThreadPool(nworkers)
+    else:
+        pool = multiprocessing.Pool(nworkers, _set_shared_target, (sharedTarget,))
+    return pool
+
+
+def _close_pool(pool, terminate=False):
+    '''Wait for the workers to finish, or stop them right away (e.g., after an error)'''
+    if pool is None:
+        return
+    if terminate:
+        pool.terminate()
+    else:
+        pool.close()
+    pool.join()
+
+
+_sharedTarget = None # Prepared target of the current worker process (see _make_pool)
+
+def _set_shared_target(sharedTarget):
+    global _sharedTarget
+    _sharedTarget = sharedTarget
+
+
+def _register_pair(task):
+    '''
+    Find transformation for (imageInd, source, target, pyramidDepth, minLevel, method,
+    engineOptions, keepHistory). If target is None, the worker's shared target is used.
+    Returns [(imageInd, tfrm, history)], where history is None unless keepHistory.
+    '''
+    (imageInd, source, target, pyramidDepth, minLevel, method, engineOptions, keepHistory) = task
+    if target is None:
+        target = _sharedTarget
+    history = [] if keepHistory else None
+    tfrm = register_image(source, target, pyramidDepth, minLevel, method, history, **engineOptions)
+    return [(imageInd, tfrm, history)]
+
+
+def _register_run(task):
+    '''
+    Find transformations for (pairs, images, pyramidDepth, minLevel, method, engineOptions,
+    keepHistory), where pairs is a run of (sourceInd, targetInd) from _neighbor_runs() and
+    images[ind] is the image with index ind (the stack, or a dict with the images of the run).
+    The pyramid of each image is built once, in a cache
+    that belongs to this task only.
+    Returns [(imageInd, tfrm, history)] for each pair (see _register_pair).
+    '''
+    (pairs, images, pyramidDepth, minLevel, method, engineOptions, keepHistory) = task
+    dtype = engineOptions.get('dtype')
+    cache = imreg.PyramidCache(maxSize=2)
+    results = []
+    for sourceInd, targetInd in pairs:
+        # -- The target was the source of the previous pair, so it is taken first (before --
+        # -- the new source is added and the least recently used image dropped) --
+        target = cache.get(images[targetInd], pyramidDepth, dtype=dtype, key=targetInd,
+                           minLevel=minLevel)
+        source = cache.get(images[sourceInd], pyramidDepth, dtype=dtype, key=sourceInd,
+                           minLevel=minLevel)
+        history = [] if keepHistory else None
+        tfrm = register_image(source, target, pyramidDepth, minLevel, method, history,
+                              **engineOptions)
+        results.append((sourceInd, tfrm, history))
+    return results
+
+
+def _warp_image(task):
+    '''Apply a transformation to an image, given (imageInd, image, tfrm)'''
+    (imageInd, image, tfrm) = task
+    return (imageInd, warp_image(image, tfrm))
+
+
 if __name__=='__main__':
     import os
     datadir = '/data/brainmix_data/test043_TL'
@@ -0,0 +1,136 @@
+'''
+Composition of image transformations.
+
+Rigid-body transformations [rotation_angle, translation_x, translation_y] and affine
+transformations are represented as (3,3) homogeneous matrices that map coordinates of
+the output image to coordinates of the input image (the convention used by
+skimage.transform.warp). A chain of transformations is composed by multiplying their
+matrices, so each original image only needs to be resampled once.
+
+See AUTHORS file for credits.
+'''
+
+import numpy as np
+import skimage.transform
+from brainmix.modules import imregistration as imreg
+
+
+def to_matrix(tfrm):
+    '''
+    Homogeneous matrix of a transformation.
+
+    Args:
+        tfrm (np.ndarray): (3,) rigid-body transformation or (3,3) affine matrix.
+
+    Returns:
+        matrix (np.ndarray): (3,3) homogeneous transformation matrix.
+    '''
+    tfrm = np.asarray(tfrm, dtype=float)
+    if tfrm.shape == (3,3):
+        return tfrm
+    return imreg.rigid_body_matrix(tfrm)
+
+
+def from_matrix(matrix, method='rigid'):
+    '''
+    Convert a homogeneous matrix to the representation used by a registration method.
+
+    Args:
+        matrix (np.ndarray): (3,3) homogeneous transformation matrix.
+        method (str): 'rigid' for (3,) parameters, 'affine' for the (3,3) matrix.
+    '''
+    if method == 'rigid':
+        return imreg.rigid_body_parameters(matrix)
+    elif method == 'affine':
+        return np.asarray(matrix, dtype=float)
+    else:
+        raise ValueError('Unknown registration method: {0}'.format(method))
+
+
+def identity(nImages, method='rigid'):
+    '''
+    Return the transformations that leave every image of a stack unchanged.
+
+    Args:
+        nImages (int): number of images.
+        method (str): 'rigid' for [nImages, 3] parameters, 'affine' for [nImages, 3, 3] matrices.
+    '''
+    if method == 'rigid':
+        return np.zeros((nImages, 3))
+    elif method == 'affine':
+        return np.tile(np.eye(3), (nImages, 1, 1))
+    else:
+        raise ValueError('Unknown registration method: {0}'.format(method))
+
+
+def compose(*tfrms):
+    '''
+    Compose a chain of transformations into a single matrix.
+
+    If warp(a, tfrmA) is aligned to b, and warp(b, tfrmB) is aligned to c, then
+    warp(a, compose(tfrmA, tfrmB)) is aligned to c.
+
+    Returns:
+        matrix (np.ndarray): (3,3) homogeneous transformation matrix.
+    '''
+    matrix = np.eye(3)
+    for tfrm in tfrms:
+        matrix = np.dot(matrix, to_matrix(tfrm))
+    return matrix
+
+
+def chain_to_target(pairTfrms, targetInd, method='rigid'):
+    '''
+    Compose transformations between neighbors into transformations to the target.
+
+    Args:
+        pairTfrms (np.ndarray): transformation of each image to its neighbor closer
+            to the target (the value for the target itself is ignored).
+        targetInd (int): index of the target image.
+        method (str): 'rigid' or 'affine' (the representation of the results).
+
+    Returns:
+        tfrms (np.ndarray): transformation of each image to the target.
+    '''
+    nImages = len(pairTfrms)
+    tfrms = identity(nImages, method)
+    matrices = {targetInd: np.eye(3)}
+    for ind in list(range(targetInd+1, nImages)) + list(range(targetInd-1, -1, -1)):
+        neighborInd = ind+1 if ind < targetInd else ind-1
+        matrices[ind] = compose(pairTfrms[ind], matrices[neighborInd])
+        tfrms[ind] = from_matrix(matrices[ind], method)
+    return tfrms
+
+
+def rescale(tfrm, factor):
+    '''
+    Express a transformation found on scaled images in the coordinates of the original images.
+
+    Args:
+        tfrm (np.ndarray): (3,) rigid-body transformation or (3,3) affine matrix.
+        factor (float): scale of the images used to find tfrm (e.g., 0.5 for half size).
+
+    Returns:
+        tfrm (np.ndarray): transformation of the same type for images at the original scale.
+    '''
+    scaling = np.diag([factor, factor, 1.0])
+    matrix = np.dot(np.linalg.inv(scaling), np.dot(to_matrix(tfrm), scaling))
+    if np.shape(tfrm) == (3,3):
+        return matrix
+    return imreg.rigid_body_parameters(matrix)
+
+
+def warp_image(image, tfrm, output_shape=None):
+    '''
+    Resample an image once according to a (possibly composed) transformation.
+
+    Args:
+        image (np.ndarray): grayscale image to transform.
+        tfrm (np.ndarray): (3,) rigid-body transformation or (3,3) affine matrix.
+        output_shape (tuple): (optional) shape of the output image. Default: same as image.
+
+    Returns:
+        outimg (np.ndarray): transformed image (cubic spline interpolation).
+    '''
+    return skimage.transform.warp(image, to_matrix(tfrm), output_shape=output_shape,
+                                  order=3, mode='nearest')
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+'''
+convergence_test.py
+Purpose: Check the stopping rules of imregistration.ConvergenceController
+(stall, rejected steps, lambda bounds) and the history it records.
+Run with: python -m pytest brainmix/tests/convergence_test.py
+'''
+
+import numpy as np
+from brainmix.modules import imregistration as imreg
+from brainmix.tests.synthetic import make_image_pair
+
+def test_stall_stop():
+    convergence = imreg.ConvergenceController(stallTolerance=1e-3, stallIterations=2)
+    convergence.start(1.0, 100, 'rigid', 3)
+    assert convergence.update(0.9999, 1.0) and not convergence.finished
+    assert convergence.update(0.9998, 1.0) and convergence.finished
+    assert convergence.history[-1]['reason'] == 'stalled'
+
+def test_rejected_stop():
+    convergence = imreg.ConvergenceController(maxRejected=3, lambdaStart=1.0, lambdaFactor=10.0)
+    convergence.start(1.0, 100)
+    for ind in range(3):
+        assert not convergence.finished
+        assert not convergence.update(2.0, 1.0)
+    assert convergence.finished
+    assert convergence.history[-1]['reason'] == 'rejected'
+    assert convergence.lambdavar == 1000.0
+
+def test_lambda_bounds():
+    # -- A rejected step when lambda is already at its maximum stops the level --
+    convergence = imreg.ConvergenceController(maxRejected=100, lambdaMax=10.0, lambdaFactor=10.0)
+    convergence.start(1.0, 100)
+    convergence.update(2.0, 1.0)
+    assert convergence.lambdavar == 10.0 and not convergence.finished
+    convergence.update(2.0, 1.0)
+    assert convergence.lambdavar == 10.0 and convergence.finished
+    assert convergence.history[-1]['reason'] == 'rejected'
+    # -- Accepted steps do not reduce lambda below its minimum --
+    convergence = imreg.ConvergenceController(lambdaMin=0.1, lambdaFactor=10.0)
+    convergence.start(1.0, 100)
+    for meanSquares in [0.5, 0.25, 0.125]:
+        convergence.update(meanSquares, 1.0)
+    assert convergence.lambdavar == 0.1 and not convergence.finished
+
+def test_history():
+    convergence = imreg.ConvergenceController(maxIterations={2: 2}, minDisplacement=0.01)
+    convergence.start(1.0, convergence.max_iterations(2), 'rigid', 2)
+    convergence.update(0.5, 1.0)
+    convergence.update(0.4, 1.0)
+    convergence.start(0.4, convergence.max_iterations(1), 'affine', 1)
+    convergence.update(0.3, 0.001)
+    assert convergence.history == [
+        {'stage':'rigid', 'layer':2, 'iterations':2, 'meanSquares':0.4, 'reason':'iterations'},
+        {'stage':'affine', 'layer':1, 'iterations':1, 'meanSquares':0.3, 'reason':'displacement'}]
+    assert convergence.iterations('affine') == [('affine', 1, 1)]
+    assert convergence.copy().history == []
+
+def test_registration_history():
+    (source, target, expected) = make_image_pair()
+    pyramidDepth = imreg.get_pyramid_depth(target)
+    convergence = imreg.ConvergenceController()
+    imreg.rigid_body_registration(source, target, pyramidDepth, 1, convergence=convergence)
+    layers = [level['layer'] for level in convergence.history]
+    assert layers == range(pyramidDepth, 0, -1)
+    meanSquares = [level['meanSquares'] for level in convergence.history]
+    assert all(np.isfinite(meanSquares))
+    assert all(0 < level['iterations'] <= convergence.max_iterations(level['layer'])
+               for level in convergence.history)
+
+if __name__ == '__main__':
+    test_stall_stop()
+    test_rejected_stop()
+    test_lambda_bounds()
+    test_history()
+    test_registration_history()
+    print 'All convergence checks passed.'
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+'''
+fft_initialization_test.py
+Purpose: Check that the Fourier-Mellin initialization (init='fft') recovers
+rotations that are too large for the center-of-mass initialization.
+Run with: python -m pytest brainmix/tests/fft_initialization_test.py
+'''
+
+import numpy as np
+from brainmix.modules import imregistration as imreg
+from brainmix.tests.synthetic import make_image_pair
+
+def make_rotated_pair():
+    '''Image pair rotated around its center by more than the center-of-mass init handles'''
+    (source, target, expected) = make_image_pair(128, (0.6, 6.0, -4.0), sigma=4, centered=True)
+    return (source, target, imreg.rigid_body_parameters(expected))
+
+def test_fourier_mellin_initialization():
+    (source, target, expected) = make_rotated_pair()
+    tfrm = imreg.fourier_mellin_initialization(source, target)
+    assert abs(tfrm[0]-expected[0]) < 0.02
+    assert np.all(np.abs(tfrm[1:]-expected[1:]) < 2)
+
+def test_rigid_fft_init():
+    (source, target, expected) = make_rotated_pair()
+    pyramidDepth = imreg.get_pyramid_depth(target)
+    tfrm = imreg.rigid_body_registration(source, target, pyramidDepth, 0, init='fft')
+    assert abs(tfrm[0]-expected[0]) < 1e-2
+    assert np.all(np.abs(tfrm[1:]-expected[1:]) < 1)
+
+if __name__ == '__main__':
+    test_fourier_mellin_initialization()
+    test_rigid_fft_init()
+    print 'All FFT initialization checks passed.'
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+'''
+float32_registration_test.py
+Purpose: Check that registering in single precision (dtype=np.float32)
+gives the same transformations as the default double precision, and that
+both recover the known transformation.
+Run with: python -m pytest brainmix/tests/float32_registration_test.py
+'''
+
+import numpy as np
+from brainmix.modules import imregistration as imreg
+from brainmix.modules import affineregistration as affreg
+from brainmix.tests.synthetic import make_image_pair
+
+def test_gradient_float32():
+    (source, target, expected) = make_image_pair()
+    (gx64, gy64) = imreg.image_gradient(target)
+    (gx32, gy32) = imreg.image_gradient(target.astype(np.float32))
+    assert gx32.dtype == np.float32
+    assert np.allclose(gx32, gx64, atol=1e-5) and np.allclose(gy32, gy64, atol=1e-5)
+
+def test_rigid_float32():
+    (source, target, expected) = make_image_pair()
+    expected = imreg.rigid_body_parameters(expected)
+    pyramidDepth = imreg.get_pyramid_depth(target)
+    tfrm64 = imreg.rigid_body_registration(source, target, pyramidDepth, 1)
+    tfrm32 = imreg.rigid_body_registration(source, target, pyramidDepth, 1, dtype=np.float32)
+    assert abs(tfrm32[0]-tfrm64[0]) < 1e-3
+    assert np.all(np.abs(tfrm32[1:]-tfrm64[1:]) < 0.05)
+    # -- With minLevel=1, the finest level has half the resolution --
+    for tfrm in (tfrm64, tfrm32):
+        assert abs(tfrm[0]-expected[0]) < 5e-3
+        assert np.all(np.abs(tfrm[1:]-expected[1:]) < 0.25)
+
+def test_affine_float32():
+    (source, target, expected) = make_image_pair()
+    pyramidDepth = imreg.get_pyramid_depth(target)
+    tfrm64 = affreg.affine_registration(source, target, pyramidDepth, 1)
+    tfrm32 = affreg.affine_registration(source, target, pyramidDepth, 1, dtype=np.float32)
+    assert np.all(np.abs(tfrm32[:2,:2]-tfrm64[:2,:2]) < 1e-3)
+    assert np.all(np.abs(tfrm32[:2,2]-tfrm64[:2,2]) < 0.05)
+    for tfrm in (tfrm64, tfrm32):
+        assert np.all(np.abs(tfrm[:2,:2]-expected[:2,:2]) < 5e-3)
+        assert np.all(np.abs(tfrm[:2,2]-expected[:2,2]) < 0.25)
+
+if __name__ == '__main__':
+    test_gradient_float32()
+    test_rigid_float32()
+    test_affine_float32()
+    print 'All float32 checks passed.'
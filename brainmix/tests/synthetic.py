@@ -0,0 +1,27 @@
+'''
+synthetic.py
+Purpose: Synthetic images with a known transformation, shared by the registration tests.
+'''
+
+import numpy as np
+import scipy.ndimage
+import skimage.transform
+from brainmix.modules import imregistration as imreg
+
+def make_image_pair(size=192, tfrm=(0.05, 4.3, -2.7), sigma=5, centered=False):
+    '''
+    Smooth random image (target) and a version of it transformed by the rigid-body
+    transformation tfrm (source), rotating around the origin or, if centered, around
+    the center of the image. Returns also the (3,3) matrix that registers them
+    (the inverse of the transformation).
+    '''
+    randomState = np.random.RandomState(0)
+    target = scipy.ndimage.gaussian_filter(randomState.rand(size, size), sigma)
+    target = (target-target.min())/(target.max()-target.min())
+    matrix = imreg.rigid_body_matrix(tfrm)
+    if centered:
+        center = (size-1)/2.0
+        toCenter = np.array([[1, 0, center], [0, 1, center], [0, 0, 1.0]])
+        matrix = np.dot(toCenter, np.dot(matrix, np.linalg.inv(toCenter)))
+    source = skimage.transform.warp(target, matrix, order=3, mode='nearest')
+    return (source, target, np.linalg.inv(matrix))